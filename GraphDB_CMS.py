@@ -1,16 +1,39 @@
 from py2neo import neo4j, cypher, geoff
+from cache import LRUCache
+from instrumentation import instrumented
+import connections
 import datetime
+import io
+import threading
+
+#Node ids of the value nodes by (database, value), shared by all stores in the process
+VALUE_NODES = LRUCache(100000)
 
 class DocumentStore:
     """
     The document management system
+    The duplicate relationships older versions of saveFile wrote are removed before the first save, see ensureUniqueRelationships
     """
     
-    def __init__(self, connectionData): 
+    def __init__(self, connectionData, connectionManager=None, fullText=False, chunkSize=None): 
         """
         @param connectionData: http://localhost:7474/db/data/
+        @param connectionManager the ConnectionManager sharing the service between stores, None for connections.default
+        @param fullText keep the current content of the documents in the content fulltext index for searchText
+        @param chunkSize content longer than this number of characters is saved as chunk nodes of chunkSize characters
+            which openContent reads a few at a time, None to keep all content in the content node
         """
-        self.__graphDB = neo4j.GraphDatabaseService(connectionData)
+        if connectionManager is None:
+            connectionManager = connections.default
+        self.__graphDB = connectionManager.graph(connectionData)
+        self.__connectionData = connectionData
+        #The root nodes and indexes are looked up once for all stores of the manager, see refreshHandles
+        self.__handles = connectionManager.graphHandles(connectionData)
+        #The facet cache is shared by all stores of the manager like the handles
+        self.__facets = connectionManager.shared(("facets", connectionData), lambda: dict(counts=None, lock=threading.Lock()))
+        self.fullText = fullText
+        self.chunkSize = chunkSize
+        self.instrumentation = None
     
     @property
     def connection(self):
@@ -24,15 +47,17 @@ class DocumentStore:
         """
         @return the 0 node
         """
-        return self.connection.get_reference_node()
+        return self.__handle("reference", lambda: self.request("get_reference_node", self.connection.get_reference_node))
         
-    def createDocument(self, name, language):
+    @instrumented
+    def createDocument(self, name, language, lazy=False):
         """
         Create a new document (if it exists the existing document is loaded
         @param name the documentName
         @param language the language your document is in
+        @param lazy only load the attributes when they are used
         """
-        doc = Document(self, name, language)
+        doc = Document(self, name, language, lazy)
         return doc
         
     @property
@@ -40,78 +65,625 @@ class DocumentStore:
         """
         @return the root for the values
         """
-        return self.reference.get_related_nodes(0, "VAL_ROOT")[0]
+        return self.__roots()["VAL_ROOT"]
         
     @property
     def documentRoot(self):
         """
         @return the root for the documents
         """
-        return self.reference.get_related_nodes(0, "DOC_ROOT")[0]
+        return self.__roots()["DOC_ROOT"]
         
     @property
     def userRoot(self):
         """
         @return the root for the users
         """
-        return self.reference.get_related_nodes(0, "USER_ROOT")[0]
+        return self.__roots()["USER_ROOT"]
         
     @property
     def valueIndex(self):
         """
         @return the index for the values
         """
-        return self.connection.get_index(neo4j.Node, "values")
+        return self.__handle("values", lambda: self.request("get_index", self.connection.get_index, neo4j.Node, "values"))
         
     @property
     def userIndex(self):
         """
         @return the index for the users
         """
-        return self.connection.get_index(neo4j.Node, "users")
+        return self.__handle("users", lambda: self.request("get_index", self.connection.get_index, neo4j.Node, "users"))
         
     @property
     def documentIndex(self):
         """
         @return the index for the documents
         """
-        return self.connection.get_index(neo4j.Node, "documents")
+        return self.__handle("documents", lambda: self.request("get_index", self.connection.get_index, neo4j.Node, "documents"))
+        
+    @property
+    def contentIndex(self):
+        """
+        @return the fulltext index for the current content
+        """
+        return self.__handle("content", lambda: self.request("get_index", self.connection.get_index, neo4j.Node, "content"))
+        
+    def refreshHandles(self):
+        """
+        Forget the root nodes, indexes and value nodes so they are looked up again, needed when the setup is rebuilt
+        """
+        self.__handles.clear()
+        VALUE_NODES.clear()
+        
+    @instrumented
+    def validateHandles(self):
+        """
+        Check the cached root nodes against the database with 1 query, they are refreshed when they changed
+        @return True when the cached root nodes were still valid
+        """
+        if "roots" not in self.__handles:
+            return True
+        valid = self.__loadRoots() == self.__handles["roots"]
+        if not valid:
+            self.refreshHandles()
+        return valid
+        
+    def __handle(self, name, loader):
+        """
+        @return the cached handle with name, loader is called to get it the first time
+        """
+        handle = self.__handles.get(name)
+        if handle is None:
+            handle = loader()
+            self.__handles[name] = handle
+        return handle
+        
+    def __roots(self):
+        """
+        @return dict with the root nodes by relationship type, loaded with 1 query
+        """
+        return self.__handle("roots", self.__loadRoots)
+        
+    def __loadRoots(self):
+        """
+        @return dict with the root nodes by relationship type
+        """
+        query = "start ref=node(0) match ref-[:VAL_ROOT]->v, ref-[:DOC_ROOT]->d, ref-[:USER_ROOT]->u return v, d, u"
+        row = self.execute(query)[0]
+        return {"VAL_ROOT": row[0], "DOC_ROOT": row[1], "USER_ROOT": row[2]}
+        
+    def getValueIds(self, values):
+        """
+        Look up values in the value node cache
+        @return (ids, missing) with the node id per cached value and the list of values that aren't cached
+        """
+        ids = dict()
+        missing = list()
+        for value in values:
+            id = VALUE_NODES.get((self.__connectionData, value))
+            if id is None:
+                missing.append(value)
+            else:
+                ids[value] = id
+        return ids, missing
         
+    def internValues(self, ids):
+        """
+        Add value nodes to the cache, only for value nodes that are linked to the value root
+        @param ids dict with the node id per value
+        """
+        for value, id in ids.items():
+            VALUE_NODES.put((self.__connectionData, value), id)
+        
+    @instrumented
+    def resolveValues(self, values):
+        """
+        Get or create the value nodes for a lot of values
+        Values that aren't cached cost 2 requests together: 1 batch for the index and 1 query linking them to the value root
+        @return dict with the node id per value
+        """
+        ids, missing = self.getValueIds(values)
+        if len(missing) > 0:
+            batch = neo4j.WriteBatch(self.connection)
+            for value in missing:
+                batch.get_or_create_indexed_node(self.valueIndex, "value", value, dict(value=value))
+            created = dict(zip(missing, [node.id for node in self.request("batch", batch.submit)]))
+            query = "start vroot=node({ROOT}), v=node({IDS}) create unique vroot-[:VALUE]->v"
+            self.execute(query, {"ROOT": self.valueRoot.id, "IDS": list(created.values())})
+            self.internValues(created)
+            ids.update(created)
+        return ids
+        
+    @instrumented
+    def removeDuplicateRelationships(self):
+        """
+        Keep only 1 of the DOCUMENT, ALLOWED, attribute, VALUE and IS_USER relationships between the same 2 nodes
+        Older versions of saveFile created these again for every save, saveFile now writes them with CREATE UNIQUE
+        which fails on a document with duplicates, ensureUniqueRelationships runs this when the database has any
+        Running it on a database without duplicates changes nothing
+        """
+        dedupe = " with a, b, type(r) as type, collect(distinct r) as rels where length(rels) > 1 foreach (r in tail(rels) : delete r)"
+        queries = [
+            #The DOCUMENT relationships first, the other queries find the documents through them
+            ("start droot=node({ROOT}) match a-[r:DOCUMENT]->b where a = droot", self.documentRoot),
+            ("start droot=node({ROOT}) match droot-[:DOCUMENT]->b<-[r:ALLOWED]-a", self.documentRoot),
+            ("start droot=node({ROOT}) match droot-[:DOCUMENT]->a-[r]->b where has(b.value)", self.documentRoot),
+            ("start droot=node({ROOT}) match droot-[:DOCUMENT]->d-->a-[r]->b where has(b.value) and not(has(a.value))", self.documentRoot),
+            ("start vroot=node({ROOT}) match a-[r:VALUE]->b where a = vroot", self.valueRoot),
+            ("start uroot=node({ROOT}) match a-[r:IS_USER]->b where b = uroot", self.userRoot),
+        ]
+        for query, root in queries:
+            self.execute(query + dedupe, {"ROOT": root.id})
+        
+    def ensureUniqueRelationships(self):
+        """
+        Remove the duplicate relationships of older versions of saveFile before anything is saved with CREATE UNIQUE,
+        checked with 1 query the first time for the database, saveFile calls this before its first request
+        """
+        self.__handle("unique", self.__removeDuplicates)
+        
+    def __removeDuplicates(self):
+        """
+        Run removeDuplicateRelationships when any 2 nodes have more than 1 relationship of the same type
+        @return True
+        """
+        query = "start n=node(*) match n-[r]->m with n, m, type(r) as type, count(r) as rels where rels > 1 return type limit 1"
+        if len(self.execute(query)) > 0:
+            self.removeDuplicateRelationships()
+        return True
+        
+    def execute(self, query, params=None):
+        """
+        Run a cypher query
+        @return the rows of the result
+        """
+        return self.request("cypher", cypher.execute, self.connection, query, params or dict())[0]
+        
+    def request(self, operation, method, *args):
+        """
+        Do 1 request to Neo4j by calling method, counted as a round trip by the instrumentation
+        @param operation the name of the request for the instrumentation
+        @return the result of method
+        """
+        if self.instrumentation is None:
+            return method(*args)
+        return self.instrumentation.roundTrip("neo4j", operation, method, *args)
+        
+    def enableInstrumentation(self, instrumentation):
+        """
+        Count the calls and Neo4j requests of this store and its documents in instrumentation
+        """
+        self.instrumentation = instrumentation
+        
+    def disableInstrumentation(self):
+        """
+        Stop counting calls and requests
+        """
+        self.instrumentation = None
+        
+    @instrumented
+    def checkPermissions(self, documentNames, username):
+        """
+        Check the access of username to a lot of documents with 1 query
+        @return dict with True or False per document name
+        """
+        query = "start u=node:users(username={USER}) match u-[:ALLOWED]->d where d.documentName in {NAMES} return distinct d.documentName"
+        allowed = set(row[0] for row in self.execute(query, {"USER": username, "NAMES": list(documentNames)}))
+        return dict((name, name in allowed) for name in documentNames)
+        
+    @instrumented
+    def getAllowedDocuments(self, username, after=None, limit=50):
+        """
+        Get 1 page of the names of the documents username has access to, sorted by name
+        @param after the next value returned for the previous page, None for the first page
+        @param limit the number of names on a page
+        @return (names, next) where next is the after value for the next page or None after the last page
+        """
+        params = {"USER": username, "LIMIT": limit}
+        query = "start u=node:users(username={USER}) match u-[:ALLOWED]->d"
+        if after is not None:
+            query += " where d.documentName > {AFTER}"
+            params["AFTER"] = after
+        query += " return distinct d.documentName as name order by name limit {LIMIT}"
+        names = [row[0] for row in self.execute(query, params)]
+        next = None
+        if len(names) == limit:
+            next = names[-1]
+        return names, next
+        
+    def iterAllowedDocuments(self, username, batchSize=100):
+        """
+        Stream the names of all documents username has access to page by page
+        """
+        after = None
+        while True:
+            names, after = self.getAllowedDocuments(username, after, batchSize)
+            for name in names:
+                yield name
+            if after is None:
+                break
+        
+    @instrumented
+    def facetSearch(self, filters, language=None, facets=None, matchAll=True):
+        """
+        Find documents by their attributes with 1 query
+        @param filters dict with a value or a list of values per attribute key, a document matches a key when it has any of the values
+        @param language also match the translatable attributes of the translation in language
+        @param facets the attribute keys to count the values of, None for all
+        @param matchAll True when a document has to match all keys, False when matching 1 key is enough
+        @return (names, counts) with the sorted names of the matching documents and the number of matching documents per key and value
+        """
+        if len(filters) == 0:
+            return list(), dict()
+        params = dict()
+        def owner(name):
+            #The document or, with a language, the document or its translation in that language
+            if language is None:
+                return "d"
+            return "d-[:" + language.upper() + "*0..1]->" + name
+        start = list()
+        keys = list()
+        for i, (key, values) in enumerate(filters.items()):
+            if type(values) != list:
+                values = [values]
+            params["Q%d" % i] = self.__luceneQuery("value", values)
+            params["V%d" % i] = values
+            keys.append((key.upper(), i))
+            start.append("v%d=node:values({Q%d})" % (i, i))
+        if matchAll:
+            match = [owner("o%d" % i) + "-[:" + key + "]->v%d" % i for key, i in keys]
+            query = "start " + ", ".join(start) + " match " + ", ".join(match) + " where has(d.documentName)"
+        else:
+            params["Q"] = " OR ".join("(" + params["Q%d" % i] + ")" for key, i in keys)
+            condition = " or ".join("(type(r) = '" + key + "' and v.value in {V%d})" % i for key, i in keys)
+            query = "start v=node:values({Q}) match " + owner("o") + "-[r]->v where has(d.documentName) and (" + condition + ")"
+        query += " with distinct d match " + owner("o") + "-[f]->fv where has(fv.value) return d.documentName, type(f), fv.value"
+        names = set()
+        counts = dict()
+        for name, key, value in self.execute(query, params):
+            names.add(name)
+            key = key.lower()
+            if facets is None or key in facets:
+                values = counts.setdefault(key, dict())
+                values[value] = values.get(value, 0) + 1
+        return sorted(names), counts
+        
+    @property
+    def facetCounts(self):
+        """
+        Document count per attribute key and value, shared by the stores of the ConnectionManager, None when the facet cache isn't enabled
+        """
+        return self.__facets["counts"]
+        
+    @facetCounts.setter
+    def facetCounts(self, counts):
+        self.__facets["counts"] = counts
+        
+    @instrumented
+    def enableFacetCache(self):
+        """
+        Count the documents per attribute key and value with 1 query and keep the counts up to date in saveFile of the stores of the ConnectionManager
+        Only the attributes of the documents are counted, not the translatable ones
+        """
+        self.facetCounts = self.__countFacets()
+        
+    def disableFacetCache(self):
+        """
+        Stop keeping the facet counts
+        """
+        self.facetCounts = None
+        
+    @instrumented
+    def getFacetCounts(self, facets=None):
+        """
+        @param facets the attribute keys to count the values of, None for all
+        @return the number of documents per attribute key and value, from the facet cache when it's enabled
+        """
+        counts = self.facetCounts
+        if counts is None:
+            counts = self.__countFacets()
+        with self.__facets["lock"]:
+            return dict((key, dict(values)) for key, values in counts.items() if facets is None or key in facets)
+        
+    def addFacetCounts(self, pairs):
+        """
+        Count the (key, value) pairs a document got in the facet cache
+        """
+        counts = self.facetCounts
+        if counts is not None:
+            with self.__facets["lock"]:
+                for key, value in pairs:
+                    values = counts.setdefault(key.lower(), dict())
+                    values[value] = values.get(value, 0) + 1
+        
+    def __countFacets(self):
+        """
+        @return the number of documents per attribute key and value
+        """
+        query = "start droot=node({ROOT}) match droot-[:DOCUMENT]->d-[r]->v where has(v.value) return type(r), v.value, count(distinct d)"
+        counts = dict()
+        for key, value, count in self.execute(query, {"ROOT": self.documentRoot.id}):
+            counts.setdefault(key.lower(), dict())[value] = count
+        return counts
+        
+    @instrumented
+    def searchText(self, username, text, language=None, limit=20, candidates=None):
+        """
+        Search the current content of the documents username is allowed on, needs fullText
+        The fulltext index finds the content ids with 1 query per word, limited on the server, the contents matching
+        the most words are fetched with 1 more query and ranked on the frequency of the words of text in them
+        @param text the words to search for
+        @param language only documents in language, None for all languages
+        @param candidates the number of matches read per word and of contents fetched to rank, None for 5 times limit
+            when more documents match a word some of them are not ranked
+        @return the best limit results as dict(documentName, language, score, content), the most relevant first
+        """
+        words = text.lower().split()
+        if len(words) == 0:
+            return list()
+        if candidates is None:
+            candidates = 5 * limit
+        candidates = max(candidates, limit)
+        query = "start c=node:content({QUERY}), u=node:users(username={USER}) match u-[:ALLOWED]->d-[l]->t-[:CURRENT]->c"
+        params = {"USER": username, "CANDIDATES": candidates}
+        if language is not None:
+            query += " where type(l) = {LANGUAGE}"
+            params["LANGUAGE"] = language.upper()
+        query += " return distinct id(c), d.documentName, type(l) limit {CANDIDATES}"
+        matches = dict()
+        for word in set(words):
+            params["QUERY"] = self.__luceneQuery("content", [word])
+            for id, name, lang in self.execute(query, params):
+                match = matches.setdefault(id, [0, name, lang])
+                match[0] += 1
+        if len(matches) == 0:
+            return list()
+        best = sorted(matches, key=lambda id: matches[id][0], reverse=True)[:candidates]
+        query = "start c=node({IDS}) return id(c), c.content?, c.chunks?"
+        results = list()
+        for id, content, chunks in self.execute(query, {"IDS": best}):
+            if chunks is not None:
+                content = ContentReader(self, id, chunks).read()
+            found = content.lower().split()
+            score = sum(found.count(word) for word in words) / (len(found) ** 0.5 or 1)
+            results.append(dict(documentName=matches[id][1], language=matches[id][2], score=score, content=content))
+        results.sort(key=lambda result: result["score"], reverse=True)
+        return results[:limit]
+        
+    @instrumented
     def getDocumentContent(self, documentName, language):
         """
         Get document in latest version
         """
-        query = "start n=node:documents(documentName={DOC}) match (n)-[:"+language+"]->(l)-[:CURRENT]->(c) return c.content"
-        result = cypher.execute(self.connection, query, {"DOC": documentName})
-        return result[0][0][0]
+        query = "start n=node:documents(documentName={DOC}) match (n)-[:"+language+"]->(l)-[:CURRENT]->(c) return c.content?"
+        result = self.execute(query, {"DOC": documentName})
+        if result[0][0] is None:
+            return self.openContent(documentName, language).read()
+        return result[0][0]
+        
+    @instrumented
+    def getDocumentContents(self, documentNames, language):
+        """
+        Get a lot of documents in latest version with 1 query
+        @return dict with the content per document name, documents without content in language are left out
+        """
+        if len(documentNames) == 0:
+            return dict()
+        query = "start n=node:documents({QUERY}) match (n)-[:"+language+"]->(l)-[:CURRENT]->(c) return n.documentName, c.content?, id(c), c.chunks?"
+        result = self.execute(query, {"QUERY": self.__luceneQuery("documentName", documentNames)})
+        return dict((row[0], row[1] if row[3] is None else ContentReader(self, row[2], row[3]).read()) for row in result)
+        
+    @instrumented
+    def openContent(self, documentName, language, chunksPerRequest=8):
+        """
+        Open the current content of a document for reading in parts, chunked content is fetched chunksPerRequest chunks
+        at a time so the memory used doesn't depend on the size of the content
+        @return a file-like object with read(size), None when the document has no content in language
+        """
+        query = "start n=node:documents(documentName={DOC}) match (n)-[:"+language+"]->(l)-[:CURRENT]->(c) return c.content?, id(c), c.chunks?"
+        result = self.execute(query, {"DOC": documentName})
+        if len(result) == 0:
+            return None
+        content, id, chunks = result[0]
+        if chunks is None:
+            return io.StringIO(content)
+        return ContentReader(self, id, chunks, chunksPerRequest)
+        
+    @instrumented
+    def readChunks(self, contentId, first, limit):
+        """
+        Read limit chunks of a chunked content node with 1 query
+        @param first the index of the first chunk
+        @return the list of chunks
+        """
+        query = "start c=node({C}) match c-[r:CHUNK]->k where r.index >= {FIRST} return k.data order by r.index limit {LIMIT}"
+        return [row[0] for row in self.execute(query, {"C": contentId, "FIRST": first, "LIMIT": limit})]
+        
+    @instrumented
+    def getVersionPage(self, documentName, language, after=None, limit=20):
+        """
+        Get 1 page of the content history of a document, sorted by version
+        @param after the next value returned for the previous page, None for the first page
+        @param limit the number of versions on a page
+        @return (versions, next) with a dict(version, content) per version and the after value for the next page or None after the last page
+        """
+        query = ("start n=node:documents(documentName={DOC}) match (n)-[:"+language+"]->(l)-[r:HAS_CONTENT]->(c)"
+                 " where r.version > {AFTER} return r.version, c.content?, id(c), c.chunks? order by r.version limit {LIMIT}")
+        result = self.execute(query, {"DOC": documentName, "AFTER": -1 if after is None else after, "LIMIT": limit})
+        versions = [dict(version=row[0], content=row[1] if row[3] is None else ContentReader(self, row[2], row[3]).read()) for row in result]
+        next = None
+        if len(versions) == limit:
+            next = versions[-1]["version"]
+        return versions, next
+        
+    def iterVersions(self, documentName, language, batchSize=20):
+        """
+        Stream the content history of a document page by page, oldest version first
+        """
+        after = None
+        while True:
+            versions, after = self.getVersionPage(documentName, language, after, batchSize)
+            for version in versions:
+                yield version
+            if after is None:
+                break
+        
+    @instrumented
+    def getDocumentNames(self, after=None, limit=100):
+        """
+        Get 1 page of the names of all documents in the documents index, sorted by name
+        @param after the next value returned for the previous page, None for the first page
+        @param limit the number of names on a page
+        @return (names, next) where next is the after value for the next page or None after the last page
+        """
+        params = {"LIMIT": limit}
+        query = "start d=node:documents(\"documentName:*\")"
+        if after is not None:
+            query += " where d.documentName > {AFTER}"
+            params["AFTER"] = after
+        query += " return d.documentName as name order by name limit {LIMIT}"
+        names = [row[0] for row in self.execute(query, params)]
+        next = None
+        if len(names) == limit:
+            next = names[-1]
+        return names, next
+        
+    @instrumented
+    def exportDocuments(self, documentNames):
+        """
+        Read everything about a lot of documents with 4 queries, whatever the number of documents
+        @return dict per document name with
+            versions: dict with the contents per language, oldest version first
+            attributes: dict with the values per attribute key
+            translated: dict with the values per attribute key per language
+            users: the usernames with access to the document
+        """
+        documents = dict((name, dict(versions=dict(), attributes=dict(), translated=dict(), users=list())) for name in documentNames)
+        if len(documents) == 0:
+            return documents
+        params = {"QUERY": self.__luceneQuery("documentName", documentNames)}
+        query = "start d=node:documents({QUERY}) match d-[l]->t-[r:HAS_CONTENT]->c return d.documentName, type(l), c.content?, id(c), c.chunks? order by r.version"
+        for name, language, content, id, chunks in self.execute(query, params):
+            if chunks is not None:
+                content = ContentReader(self, id, chunks).read()
+            documents[name]["versions"].setdefault(language, list()).append(content)
+        # Value nodes have no outgoing relationships so d-[]->t-[]->v only matches attributes of translations
+        query = "start d=node:documents({QUERY}) match d-[r]->v where has(v.value) return d.documentName, type(r), v.value"
+        for name, key, value in self.execute(query, params):
+            documents[name]["attributes"].setdefault(key, list()).append(value)
+        query = "start d=node:documents({QUERY}) match d-[l]->t-[r]->v where has(v.value) return d.documentName, type(l), type(r), v.value"
+        for name, language, key, value in self.execute(query, params):
+            documents[name]["translated"].setdefault(language, dict()).setdefault(key, list()).append(value)
+        query = "start d=node:documents({QUERY}) match u-[:ALLOWED]->d return distinct d.documentName, u.username"
+        for name, username in self.execute(query, params):
+            documents[name]["users"].append(username)
+        return documents
+        
+    def __luceneQuery(self, key, values):
+        """
+        @return a lucene query for the index matching any of values for key
+        """
+        terms = ['"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for value in values]
+        return key + ":(" + " OR ".join(terms) + ")"
+    
+class ContentReader:
+    """
+    Reads chunked content in parts, the chunks are fetched when they are needed
+    """
+    
+    def __init__(self, store, contentId, chunks, chunksPerRequest=8):
+        """
+        @param contentId the id of the content node
+        @param chunks the number of chunks of the content
+        @param chunksPerRequest the number of chunks fetched with 1 query
+        """
+        self.__store = store
+        self.__contentId = contentId
+        self.__chunks = chunks
+        self.__chunksPerRequest = chunksPerRequest
+        self.__next = 0
+        self.__buffer = ""
+        
+    def read(self, size=-1):
+        """
+        @return at most size characters, all remaining characters when size is negative, "" at the end
+        """
+        while (size < 0 or len(self.__buffer) < size) and self.__fetch():
+            pass
+        if size < 0:
+            size = len(self.__buffer)
+        result = self.__buffer[:size]
+        self.__buffer = self.__buffer[size:]
+        return result
+        
+    def __iter__(self):
+        """
+        @return generator with the content in parts of chunksPerRequest chunks
+        """
+        while len(self.__buffer) > 0 or self.__fetch():
+            yield self.read(len(self.__buffer))
+        
+    def __fetch(self):
+        """
+        Add the next chunks to the buffer with 1 query
+        @return False when there are no more chunks
+        """
+        if self.__next >= self.__chunks:
+            return False
+        chunks = self.__store.readChunks(self.__contentId, self.__next, self.__chunksPerRequest)
+        if len(chunks) == 0:
+            self.__next = self.__chunks
+            return False
+        self.__next += len(chunks)
+        self.__buffer += "".join(chunks)
+        return True
+        
+    def close(self):
+        self.__buffer = ""
+        self.__next = self.__chunks
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        self.close()
     
 class Document:
     
-    def __init__(self, store, name, language):
+    def __init__(self, store, name, language, lazy=False):
         """
+        The document node, translation, version, current content and attributes are loaded with 1 query
         @param store the document store
         @param name the unique name of the document (not language specific)
         @param language the language of this document
+        @param lazy leave the attributes out, they are loaded with a 2nd query when they are used
         """
         self.__store = store
         self.__name = name
         self.__attributes = list()
+        self.__attributesLoaded = False
+        #The (key, value) pairs of the document attributes in the database
+        self.__savedPairs = set()
+        self.__content = None
+        self.__currentContent = None
+        self.__version = 0
         self.__language = language     
         self.__documentNode = None
-        try:   
-            self.__documentNode = self.__store.documentIndex.get("documentName", name)[0]
-        except Exception:
-            print("new document")
-        if self.__documentNode is not None:
-            self.__translationDoc = self.__getCurrentLanguage()
-            self.__loadAttributes()
-        else:
-            self.__translationDoc = None
+        self.__translationDoc = None
+        self.__load(not lazy)
         
         # Simple idea of the graph
         # document -[LANGUAGE]-> version
         # document -[<ATTRIBUTE>]-> value
         
+    @property
+    def instrumentation(self):
+        """
+        @return the instrumentation of the store
+        """
+        return self.__store.instrumentation
+        
     @property
     def name(self):
         """
@@ -122,9 +694,20 @@ class Document:
     @property
     def content(self):
         """
-        @return content of the document set by the user
+        @return content of the document set by the user, or else the current content in the database
+        Chunked content isn't loaded with the document, it's read from the database every time it's asked for
         """
-        return self.__content
+        if self.__content is not None:
+            return self.__content
+        if self.__currentContent is None and self.__version > 0:
+            return self.openContent().read()
+        return self.__currentContent
+        
+    def openContent(self):
+        """
+        @return a file-like object reading the current content in the database in parts, see DocumentStore.openContent
+        """
+        return self.__store.openContent(self.__name, self.__language.upper())
         
     @property
     def documentNode(self):
@@ -136,14 +719,23 @@ class Document:
     @property
     def version(self):
         """
-        @return the current version of the document
+        @return the version the next content of the document gets
+        """
+        return self.__version
+        
+    @property
+    def attributes(self):
+        """
+        @return the attributes as a list of dict(key, value, translatable)
         """
-        version = self.__getVersion()
+        self.__ensureAttributes()
+        return self.__attributes
         
     def updateAttribute(self, key, value):
         """
         change an attribute, doesn't work for lists
         """
+        self.__ensureAttributes()
         att = self.__getAttribute(key)
         att['value'] = value
         
@@ -154,6 +746,13 @@ class Document:
         @param value can be a lsit for multiple value fields
         @param translatable if None then the key/value is used for all translations, otherwise it's only used for 1 translation
         """
+        self.__ensureAttributes()
+        self.__addAttribute(key, value, translatable)
+        
+    def __addAttribute(self, key, value, translatable=None):
+        """
+        Add attribute in memory without loading the attributes first
+        """
         existing = self.__getAttribute(key)
         if existing is not None:
             val = existing['value']
@@ -171,50 +770,158 @@ class Document:
         """
         self.__content = content
         
+    @instrumented
     def saveFile(self, user):
         """
         Save the file to Neo4J (saves attributes and content effectivly to Neo4J)
         Saving an object 2 times creates new revisions for the content
+        The save is 2 requests whatever the number of attributes: 1 batch getting or creating the indexed nodes
+        and 1 cypher query writing all relationships, the content and the version, which succeeds or fails as a whole
+        Value nodes found in the value node cache are not looked up again
+        The first save for a database checks for the duplicate relationships of older versions of saveFile before
+        any node is created, see DocumentStore.ensureUniqueRelationships
         MISSING: Removed attributes will not really be removed, only new ones added
         """
-        docIndex = self.__store.documentIndex
-        self.__documentNode = docIndex.get_or_create("documentName", self.__name, dict(documentName=self.__name))        
-        self.__store.documentRoot.create_relationship_to(self.__documentNode, "DOCUMENT")
-        self.__saveAttributes()
-        if self.__translationDoc is None:
-            self.__translationDoc = self.__store.connection.create(dict())[0]
-            self.__documentNode.create_relationship_to(self.__translationDoc, self.__language.upper())
+        store = self.__store
+        store.ensureUniqueRelationships()
+        if store.facetCounts is not None:
+            #We need to know which attributes are new to count them
+            self.__ensureAttributes()
+        ids, missing = store.getValueIds(self.__attributeValues())
+        batch = neo4j.WriteBatch(store.connection)
+        batch.get_or_create_indexed_node(store.documentIndex, "documentName", self.__name, dict(documentName=self.__name))
+        batch.get_or_create_indexed_node(store.userIndex, "username", user, dict(username=user))
+        for value in missing:
+            batch.get_or_create_indexed_node(store.valueIndex, "value", value, dict(value=value))
+        nodes = store.request("batch", batch.submit)
+        created = dict(zip(missing, [node.id for node in nodes[2:]]))
+        ids.update(created)
+        
+        query, params = self.__saveQuery(nodes[0], nodes[1], ids, created)
+        result = store.execute(query, params)
+        self.__documentNode = nodes[0]
+        self.__translationDoc = result[0][0]
+        if self.__content is not None:
+            self.__version = result[0][1] + 1
+            self.__currentContent = self.__content
+            if store.fullText:
+                self.__indexContent(result[0][2], result[0][3])
+        store.internValues(created)
+        pairs = set((att['key'].upper(), value) for att in self.__attributes if att['translatable'] == None for value in self.__values(att))
+        store.addFacetCounts(pairs - self.__savedPairs)
+        self.__savedPairs |= pairs
+        
+    def __indexContent(self, content, previous):
+        """
+        Replace the previous current content nodes by content in the fulltext index with 1 batch
+        """
+        store = self.__store
+        batch = neo4j.WriteBatch(store.connection)
+        for node in previous:
+            batch.remove_indexed_node(store.contentIndex, node=node)
+        batch.add_indexed_node(store.contentIndex, "content", self.__content, content)
+        store.request("batch", batch.submit)
+        
+    def __attributeValues(self):
+        """
+        @return the distinct values of all attributes
+        """
+        values = list()
+        for att in self.__attributes:
+            for value in self.__values(att):
+                if value not in values:
+                    values.append(value)
+        return values
+        
+    def __values(self, att):
+        """
+        @return the values of attribute att as a list
+        """
+        if type(att['value']) == list:
+            return att['value']
+        return [att['value']]
+        
+    def __saveQuery(self, documentNode, userNode, ids, created):
+        """
+        @return (query, params) for the cypher query that writes the document
+        @param ids the node id per attribute value
+        @param created the values of which the node was just created, these are linked to the value root
+        """
+        # CREATE UNIQUE makes every relationship exactly once however many times the document is saved,
+        # the translation node t is created when the document doesn't have one for the language yet
+        params = {"D": documentNode.id, "U": userNode.id}
+        start = ["ref=node(0)", "d=node({D})", "u=node({U})"]
+        unique = ["droot-[:DOCUMENT]->d", "d-[:" + self.__language.upper() + "]->t", "u-[:IS_USER]->uroot", "u-[:ALLOWED]->d"]
+        names = dict()
+        for i, value in enumerate(ids):
+            name = "v%d" % i
+            names[value] = name
+            params[name.upper()] = ids[value]
+            start.append(name + "=node({" + name.upper() + "})")
+            if value in created:
+                unique.append("vroot-[:VALUE]->" + name)
+        for att in self.__attributes:
+            owner = "d"
+            if att['translatable'] != None:
+                owner = "t"
+            for value in self.__values(att):
+                unique.append(owner + "-[:" + att['key'].upper() + "]->" + names[value])
+        query = "start " + ", ".join(start) + " match ref-[:DOC_ROOT]->droot, ref-[:VAL_ROOT]->vroot, ref-[:USER_ROOT]->uroot create unique " + ", ".join(unique)
         if self.__content is not None:
-            content = self.__store.connection.create(dict(content=self.__content))[0]
-            self.__translationDoc.create_relationship_to(content, 'HAS_CONTENT', dict(version=self.version))
-            self.__setCurrentVersion(content)
-        self.addPermission(user)
+            query += (" with t match t-[r?:HAS_CONTENT]->() with t, max(r.version) as last"
+                      " with t, case when last is null then 0 else last + 1 end as version"
+                      " create t-[:HAS_CONTENT {version: version}]->" + self.__contentPattern(params) +
+                      " with t, c, version match t-[old?:CURRENT]->oc with t, c, version, collect(old) as olds, collect(oc) as ocs"
+                      " foreach (o in olds : delete o) create t-[:CURRENT]->c return t, version, c, ocs")
+        else:
+            query += " return t"
+        return query, params
             
+    def __contentPattern(self, params):
+        """
+        @return the pattern creating the content node c and its chunk nodes for the save query, the content is added to params
+        """
+        chunkSize = self.__store.chunkSize
+        if chunkSize is None or len(self.__content) <= chunkSize:
+            params["CONTENT"] = self.__content
+            return "(c {content: {CONTENT}})"
+        chunks = [self.__content[i:i + chunkSize] for i in range(0, len(self.__content), chunkSize)]
+        params["CHUNKS"] = len(chunks)
+        pattern = "(c {chunks: {CHUNKS}})"
+        for i, chunk in enumerate(chunks):
+            params["CHUNK%d" % i] = chunk
+            pattern += ", c-[:CHUNK {index: %d}]->({data: {CHUNK%d}})" % (i, i)
+        return pattern
+        
+    @instrumented
     def addPermission(self, username):
         """
         add permission for usernam to the current document
         """
         if self.__documentNode is not None:        
-            user = self.__store.userIndex.get("username", username)
+            store = self.__store
+            user = store.request("index_get", store.userIndex.get, "username", username)
             if user is None or len(user) == 0:
-                user = self.__store.userIndex.get_or_create("username", username, dict(username=username))
-                rel = user.create_relationship_to(self.__store.userRoot, 'IS_USER')
+                user = store.request("index_get_or_create", store.userIndex.get_or_create, "username", username, dict(username=username))
+                rel = store.request("create_relationship", user.create_relationship_to, store.userRoot, 'IS_USER')
             else:
                 user = user[0]
-            rel = user.create_relationship_to(self.__documentNode, 'ALLOWED')
+            rel = store.request("create_relationship", user.create_relationship_to, self.__documentNode, 'ALLOWED')
         else:
             print("not yet in DB")
     
+    @instrumented
     def removePermission(self, username):
         """
         remove permission for username to the current document
         """
         if self.__documentNode is not None:        
             query = "start n=node({ID}) match (n)<-[c:ALLOWED]-(u) where u.username={USER} delete c"
-            result = cypher.execute(self.__store.connection, query, {"ID": self.__documentNode.id, "USER": username})
+            result = self.__store.execute(query, {"ID": self.__documentNode.id, "USER": username})
         else:
             print("not yet in DB")
     
+    @instrumented
     def checkPermission(self, username):
         """
         @return true when username has access to the configuration
@@ -222,8 +929,8 @@ class Document:
         allowed = False
         if self.__documentNode is not None:        
             query = "start n=node({ID}) match (n)<-[:ALLOWED]-(u) where u.username={USER} return u.username"
-            result = cypher.execute(self.__store.connection, query, {"ID": self.__documentNode.id, "USER": username})
-            if len(result[0]) > 0 and result[0][0][0] == username:
+            result = self.__store.execute(query, {"ID": self.__documentNode.id, "USER": username})
+            if len(result) > 0 and result[0][0] == username:
                 allowed = True
         else:
             print("not yet in DB")
@@ -231,69 +938,44 @@ class Document:
         return allowed
         
 
-    def __setCurrentVersion(self, content):
-        """
-        Make sure that content is the current version for the current document and translation
+    def __load(self, withAttributes):
         """
-        query = "start n=node({ID}) match (n)-[r:CURRENT]->(c) delete r"
-        result = cypher.execute(self.__store.connection, query, {"ID": self.__translationDoc.id})
-        self.__translationDoc.create_relationship_to(content, 'CURRENT')
-        
-    def __loadAttributes(self):
-        """
-        Load attributes from Neo4j to memory
+        Load the document node, translation node, version, current content and optionally the attributes with 1 query
         """
-        query = "start d=node({A}) match (d)-[r]->(v) where has(v.value) return type(r) as att, v.value as value"
-        attributes = version = cypher.execute(self.__store.connection, query, {"A": self.documentNode.id})[0]
-        for att in attributes:
-            self.addAttribute(key=att[0].lower(), value=att[1])
+        # The newest HAS_CONTENT is the CURRENT one so the row with the highest version has everything we need
+        query = ("start n=node:documents(documentName={NAME}) match n-[?:" + self.__language.upper() + "]->l-[r?:HAS_CONTENT]->c"
+                 " with n, l, r.version? as version, c.content? as content order by version desc limit 1 return n, l, version, content")
+        if withAttributes:
+            query += ", extract(p in filter(p in n-->() : has(last(nodes(p)).value)) : [type(head(rels(p))), last(nodes(p)).value])"
+        result = self.__store.execute(query, {"NAME": self.__name})
+        if len(result) == 0:
+            print("new document")
+            return
+        row = result[0]
+        self.__documentNode = row[0]
+        self.__translationDoc = row[1]
+        if row[2] is not None:
+            self.__version = row[2] + 1
+        self.__currentContent = row[3]
+        if withAttributes:
+            for att in row[4]:
+                self.__addAttribute(key=att[0].lower(), value=att[1])
+                self.__savedPairs.add((att[0], att[1]))
+            self.__attributesLoaded = True
         
-    def __saveAttributes(self):
+    def __ensureAttributes(self):
         """
-        Persists the attributes, can't delete attributes
+        Load the attributes from Neo4j to memory if that didn't happen yet
         """
-        con = self.__store.connection
-        valRoot = self.__store.valueRoot
-        valueIndex = self.__store.valueIndex
-        for att in self.__attributes:
-            relation = att['key'].upper()
-            if type(att['value']) == list:
-                for value in att['value']:
-                    existing = valueIndex.get("value", value)
-                    val = None
-                    if existing is None or len(existing) == 0:
-                        val = valueIndex.get_or_create("value", value, dict(value=value))
-                        rel = valRoot.create_relationship_to(val, "VALUE")
-                    else:
-                        val = existing[0]
-                    if att['translatable'] != None:
-                        rel = self.__translationDoc.create_relationship_to(val, relation)
-                    else:
-                        rel = self.__documentNode.create_relationship_to(val, relation)
-            else:
-                val = valueIndex.get_or_create("value", att['value'], dict(value=att['value']))
-                rel = valRoot.create_relationship_to(val, "VALUE")
-                if att['translatable'] != None:
-                    rel = self.__translationDoc.create_relationship_to(val, relation)
-                else:
-                    rel = self.__documentNode.create_relationship_to(val, relation)
-                
-                
-    def __getVersion(self):
-        """
-        @return the current version
-        """
-        version = 0
-        query = "start n=node({A}) match (n)-[:"+self.__language.upper()+"]->(l)-[r:HAS_CONTENT]->(c) return max(r.version)  as max_version"
-        try:
-            version = cypher.execute(self.__store.connection, query, {"A": self.__documentNode.id})[0][0][0]
-            version +=1
-        except Exception:
-            print ("first version")
-
-        if version is None:
-                version = 0
-        return version
+        if self.__attributesLoaded:
+            return
+        self.__attributesLoaded = True
+        if self.__documentNode is not None:
+            query = "start d=node({A}) match (d)-[r]->(v) where has(v.value) return type(r) as att, v.value as value"
+            attributes = self.__store.execute(query, {"A": self.documentNode.id})
+            for att in attributes:
+                self.__addAttribute(key=att[0].lower(), value=att[1])
+                self.__savedPairs.add((att[0], att[1]))
         
     def __getAttribute(self, key):
         """
@@ -307,14 +989,6 @@ class Document:
                 
         return attribute
                 
-    def __getCurrentLanguage(self):
-        """
-        @return the current language node
-        """
-        query = "start n=node({A}) match (n)-[:"+self.__language.upper()+"]->(k) return k"
-        node = cypher.execute(self.__store.connection, query, {"A": self.__documentNode.id, "L": self.__language})[0][0][0]
-        return node
-    
             
 ## SETUP ##
 def setup():
@@ -329,6 +1003,7 @@ def indexes():
     graph_db.get_or_create_index(neo4j.Node, "values")
     graph_db.get_or_create_index(neo4j.Node, "documents")
     graph_db.get_or_create_index(neo4j.Node, "users")
+    graph_db.get_or_create_index(neo4j.Node, "content", {"type": "fulltext", "provider": "lucene"})
     
 ## TEAR DOWN ##
 def tearDown():
@@ -338,38 +1013,39 @@ def tearDown():
     cypher.execute(graph_db, query)
 
 ## RUN ##
-graph_db = neo4j.GraphDatabaseService("http://localhost:7474/db/data/")
-tearDown()
-setup()
-store = DocumentStore("http://localhost:7474/db/data/")
-doc = store.createDocument("doc_000001", 'EN')
-doc.addAttribute("organization", list({"Moonfish", "Neo Technology"}))
-doc.addAttribute("title", "First Doc")
-doc.addContent("This is the us text")
-doc.saveFile("me")
-doc2 = store.createDocument("doc_000002", 'EN')
-doc2.addAttribute("organization", list({"Sun", "Oracle"}))
-doc2.addAttribute("title", "Second Doc")
-doc2.addContent("This is another text in US")
-doc2.saveFile("me")
-doc3 = store.createDocument("doc_000003", 'FR')
-doc3.addAttribute("organization", "oracle")
-doc3.addAttribute("title", "Another document")
-doc3.addContent("This is a completely different document")
-doc3.saveFile("jos")
-doc4 = store.createDocument("doc_000004", 'FR')
-doc4.addAttribute("organization", list({"Oracle", "Microsoft"}))
-doc4.addAttribute("title", "Document 4")
-doc4.addContent("This is a completely different document")
-doc4.saveFile("jos")
-docm = store.createDocument("doc_000004", 'FR')
-docm.addContent("This is the second version")
-docm.saveFile("mark")
-print(store.getDocumentContent("doc_000004", 'FR'))
-print("Access allowed: "+str(doc.checkPermission("me")))
-print("Access allowed: "+str(doc2.checkPermission("me")))
-print("Access allowed: "+str(doc3.checkPermission("me")))
-print("Access allowed: "+str(doc4.checkPermission("me")))
-print("Access allowed: "+str(docm.checkPermission("me")))
-doc.removePermission("me")
-print("Access allowed: "+str(doc.checkPermission("me")))
\ No newline at end of file
+if __name__ == "__main__":
+    graph_db = neo4j.GraphDatabaseService("http://localhost:7474/db/data/")
+    tearDown()
+    setup()
+    store = DocumentStore("http://localhost:7474/db/data/")
+    doc = store.createDocument("doc_000001", 'EN')
+    doc.addAttribute("organization", list({"Moonfish", "Neo Technology"}))
+    doc.addAttribute("title", "First Doc")
+    doc.addContent("This is the us text")
+    doc.saveFile("me")
+    doc2 = store.createDocument("doc_000002", 'EN')
+    doc2.addAttribute("organization", list({"Sun", "Oracle"}))
+    doc2.addAttribute("title", "Second Doc")
+    doc2.addContent("This is another text in US")
+    doc2.saveFile("me")
+    doc3 = store.createDocument("doc_000003", 'FR')
+    doc3.addAttribute("organization", "oracle")
+    doc3.addAttribute("title", "Another document")
+    doc3.addContent("This is a completely different document")
+    doc3.saveFile("jos")
+    doc4 = store.createDocument("doc_000004", 'FR')
+    doc4.addAttribute("organization", list({"Oracle", "Microsoft"}))
+    doc4.addAttribute("title", "Document 4")
+    doc4.addContent("This is a completely different document")
+    doc4.saveFile("jos")
+    docm = store.createDocument("doc_000004", 'FR')
+    docm.addContent("This is the second version")
+    docm.saveFile("mark")
+    print(store.getDocumentContent("doc_000004", 'FR'))
+    print("Access allowed: "+str(doc.checkPermission("me")))
+    print("Access allowed: "+str(doc2.checkPermission("me")))
+    print("Access allowed: "+str(doc3.checkPermission("me")))
+    print("Access allowed: "+str(doc4.checkPermission("me")))
+    print("Access allowed: "+str(docm.checkPermission("me")))
+    doc.removePermission("me")
+    print("Access allowed: "+str(doc.checkPermission("me")))
\ No newline at end of file
@@ -0,0 +1,136 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import time
+from documentStore import DocumentStore
+
+class AsyncDocumentStore:
+    """
+    asyncio front-end for the DocumentStore
+    Every call runs the DocumentStore in a thread pool so the event loop never blocks on pymongo,
+    the versioning, security and caching are those of the DocumentStore
+    """
+
+    def __init__(self, host, port, workers=20, store=None, **options):
+        """
+        Create connection to host:port
+        @param workers the number of threads doing the pymongo calls, this limits the concurrent requests to MongoDB
+        @param store an existing DocumentStore to use instead of creating one
+        @param options passed to DocumentStore
+        """
+        if store is None:
+            store = DocumentStore(host, port, **options)
+        self.__store = store
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+
+    @property
+    def store(self):
+        """
+        @return the synchronous DocumentStore
+        """
+        return self.__store
+
+    def close(self):
+        """
+        Stop the threads, calls that are running are finished first
+        """
+        self.__executor.shutdown(wait=True)
+
+    async def __run(self, method, *args):
+        """
+        Run method of the DocumentStore in the thread pool
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.__executor, method, *args)
+
+    async def save(self, document):
+        """
+        See DocumentStore.save
+        """
+        return await self.__run(self.__store.save, document)
+
+    async def getLastByURI(self, uri, language):
+        """
+        See DocumentStore.getLastByURI
+        """
+        return await self.__run(self.__store.getLastByURI, uri, language)
+
+    async def getAllByURI(self, uri, language):
+        """
+        See DocumentStore.getAllByURI
+        """
+        return await self.__run(self.__store.getAllByURI, uri, language)
+
+    async def getManyByURI(self, uris, language):
+        """
+        Get the latest version of a lot of uris concurrently
+        @return list with the documents in the order of uris
+        """
+        return await asyncio.gather(*[self.getLastByURI(uri, language) for uri in uris])
+
+    async def getSearchPage(self, username, search=None, language=None, after=None, limit=50, fields=None):
+        """
+        See DocumentStore.getSearchPage
+        """
+        return await self.__run(self.__store.getSearchPage, username, search, language, after, limit, fields)
+
+    async def getBySearch(self, username, search=None, language=None, fields=None, batchSize=100):
+        """
+        Search as username, use with async for
+        The results are fetched page by page so only batchSize documents are in memory
+        """
+        after = None
+        while True:
+            documents, after = await self.getSearchPage(username, search, language, after, batchSize, fields)
+            for document in documents:
+                yield document
+            if after is None:
+                break
+
+    async def getUser(self, username):
+        """
+        See DocumentStore.getUser
+        """
+        return await self.__run(self.__store.getUser, username)
+
+    async def createUser(self, user):
+        """
+        See DocumentStore.createUser
+        """
+        return await self.__run(self.__store.createUser, user)
+
+    async def updateUser(self, user):
+        """
+        See DocumentStore.updateUser
+        """
+        return await self.__run(self.__store.updateUser, user)
+
+def benchmark(host, port, uris, language, concurrency=50, rounds=3):
+    """
+    Compare the throughput of getLastByURI for the synchronous and the async store
+    @param uris the uris to fetch, each round fetches all of them
+    @param concurrency the number of requests the async store has running at the same time
+    @return dict with the requests per second of both stores
+    """
+    store = DocumentStore(host, port)
+    start = time.time()
+    for i in range(rounds):
+        for uri in uris:
+            store.getLastByURI(uri, language)
+    syncRate = rounds * len(uris) / (time.time() - start)
+
+    asyncStore = AsyncDocumentStore(host, port, workers=concurrency, store=store)
+
+    async def run():
+        for i in range(rounds):
+            for first in range(0, len(uris), concurrency):
+                await asyncStore.getManyByURI(uris[first:first + concurrency], language)
+
+    start = time.time()
+    asyncio.run(run())
+    asyncRate = rounds * len(uris) / (time.time() - start)
+    asyncStore.close()
+    return dict(sync=syncRate, concurrent=asyncRate, concurrency=concurrency)
+
+### BENCHMARK ###
+#uris = ['/research/tag%s.html' % i for i in range(1000)]
+#print(benchmark('localhost', 27017, uris, "nl"))
@@ -0,0 +1,894 @@
+"""
+Offline benchmark of both CMS backends
+The stores run against in-process stand-ins for MongoDB and the Neo4j REST API that count the round trips
+and can add latency to each of them, so the numbers only depend on the code of the stores
+Run: python benchmark.py --documents 1000 --versions 3 --attributes 5 --latency 0.001
+"""
+import argparse
+import contextlib
+import copy
+import io
+import random
+import re
+import time
+from bson.objectid import ObjectId
+import connections
+import documentStore
+import GraphDB_CMS
+
+MISSING = object()
+
+class FakeServer:
+    """
+    The round trip counter and latency shared by all fake collections or graphs of 1 backend
+    """
+
+    def __init__(self, latency=0.0):
+        """
+        @param latency the seconds every round trip takes
+        """
+        self.latency = latency
+        self.requests = 0
+
+    def roundTrip(self):
+        """
+        Count 1 round trip and wait for the latency
+        """
+        self.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+### MONGODB ###
+
+def getPath(document, path):
+    """
+    @return the value at the dotted path in document or MISSING
+    """
+    value = document
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return MISSING
+        value = value[key]
+    return value
+
+def setPath(document, path, value):
+    """
+    Set the value at the dotted path in document
+    """
+    keys = path.split(".")
+    for key in keys[:-1]:
+        document = document.setdefault(key, dict())
+    document[keys[-1]] = value
+
+def matches(document, query):
+    """
+    @return True when document matches the query, supports the operators used by the stores
+    """
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(document, part) for part in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches(document, part) for part in condition):
+                return False
+            continue
+        value = getPath(document, key)
+        if isinstance(condition, dict) and len(condition) > 0 and all(op.startswith("$") for op in condition):
+            for op, argument in condition.items():
+                if not matchesOperator(value, op, argument):
+                    return False
+        elif not (value == condition or (isinstance(value, list) and condition in value)):
+            return False
+    return True
+
+def matchesOperator(value, op, argument):
+    """
+    @return True when value matches the query operator op with argument
+    """
+    if op == "$exists":
+        return (value is not MISSING) == argument
+    if op == "$in":
+        if isinstance(value, list):
+            return any(item in argument for item in value)
+        return value in argument
+    if op == "$nin":
+        return not matchesOperator(value, "$in", argument)
+    if op == "$ne":
+        return value != argument
+    if value is MISSING:
+        return False
+    if op == "$lt":
+        return value < argument
+    if op == "$lte":
+        return value <= argument
+    if op == "$gt":
+        return value > argument
+    if op == "$gte":
+        return value >= argument
+    raise NotImplementedError("operator " + op)
+
+def applyUpdate(document, update, inserted):
+    """
+    Apply the update operators to document
+    @param inserted True when the document is created by an upsert
+    """
+    for op, fields in update.items():
+        if op == "$setOnInsert" and not inserted:
+            continue
+        for path, value in fields.items():
+            current = getPath(document, path)
+            if op in ("$set", "$setOnInsert"):
+                setPath(document, path, copy.deepcopy(value))
+            elif op == "$inc":
+                setPath(document, path, (0 if current is MISSING else current) + value)
+            elif op == "$max":
+                if current is MISSING or value > current:
+                    setPath(document, path, value)
+            elif op == "$unset":
+                parts = path.split(".")
+                parent = getPath(document, ".".join(parts[:-1])) if len(parts) > 1 else document
+                if isinstance(parent, dict):
+                    parent.pop(parts[-1], None)
+            else:
+                raise NotImplementedError("update operator " + op)
+
+def project(document, projection):
+    """
+    @return a copy of document with only the fields of projection
+    """
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+    include = [path for path, value in projection.items() if value is True or value == 1]
+    if len(include) == 0:
+        for path, value in projection.items():
+            if value is False or value == 0:
+                document.pop(path, None)
+        return document
+    result = {"_id": document["_id"]}
+    for path in include:
+        value = getPath(document, path)
+        if value is not MISSING:
+            setPath(result, path, value)
+    return result
+
+class FakeCursor:
+    """
+    Cursor of FakeCollection.find, the documents are fetched in batches with a round trip each when it's iterated
+    """
+
+    #The size of a batch when batch_size isn't used
+    BATCH_SIZE = 101
+
+    def __init__(self, collection, query, projection):
+        self.__collection = collection
+        self.__query = query
+        self.__projection = projection
+        self.__sort = list()
+        self.__limit = 0
+        self.__batchSize = 0
+        self.__documents = None
+        self.__position = 0
+        #The number of documents fetched so far, like pymongo
+        self.retrieved = 0
+
+    def sort(self, key, direction=None):
+        if isinstance(key, list):
+            self.__sort = key
+        else:
+            self.__sort = [(key, direction or 1)]
+        return self
+
+    def limit(self, limit):
+        self.__limit = limit
+        return self
+
+    def batch_size(self, size):
+        self.__batchSize = size
+        return self
+
+    def explain(self):
+        self.__collection.server.roundTrip()
+        return {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.__position == self.retrieved:
+            if self.__documents is not None and self.retrieved == len(self.__documents):
+                raise StopIteration
+            self.__collection.server.roundTrip()
+            if self.__documents is None:
+                self.__documents = self.__results()
+            self.retrieved = min(len(self.__documents), self.retrieved + (self.__batchSize or self.BATCH_SIZE))
+            if self.__position == self.retrieved:
+                raise StopIteration
+        document = self.__documents[self.__position]
+        self.__position += 1
+        return document
+
+    next = __next__
+
+    def __results(self):
+        """
+        @return all results of the query
+        """
+        documents = [document for document in self.__collection.documents if matches(document, self.__query)]
+        for key, direction in reversed(self.__sort):
+            documents.sort(key=lambda document: getPath(document, key), reverse=direction < 0)
+        if self.__limit:
+            documents = documents[:self.__limit]
+        return [project(document, self.__projection) for document in documents]
+
+class FakeBulk:
+    """
+    Bulk operation of FakeCollection, all operations are 1 round trip
+    """
+
+    def __init__(self, collection):
+        self.__collection = collection
+        self.__operations = list()
+
+    def insert(self, document):
+        self.__operations.append(("insert", document, None, False, False))
+
+    def find(self, query):
+        operations = self.__operations
+        class Find:
+            upserting = False
+            def upsert(self):
+                self.upserting = True
+                return self
+            def update(self, update):
+                operations.append(("update", query, update, self.upserting, True))
+            def update_one(self, update):
+                operations.append(("update", query, update, self.upserting, False))
+        return Find()
+
+    def execute(self):
+        if len(self.__operations) == 0:
+            #Like pymongo
+            raise RuntimeError("No operations to execute")
+        self.__collection.server.roundTrip()
+        for kind, query, update, upsert, multi in self.__operations:
+            if kind == "insert":
+                self.__collection.store(query)
+            else:
+                self.__collection.apply(query, update, upsert, multi)
+
+class FakeCollection:
+    """
+    In memory stand-in for a pymongo collection, supports the operations used by documentStore
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.documents = list()
+
+    def store(self, document):
+        """
+        Add document without a round trip
+        @return the id of document
+        """
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        self.documents.append(copy.deepcopy(document))
+        return document["_id"]
+
+    def apply(self, query, update, upsert, multi):
+        """
+        Update the matching documents without a round trip
+        @return the first updated document
+        """
+        found = [document for document in self.documents if matches(document, query)]
+        if not multi:
+            found = found[:1]
+        for document in found:
+            applyUpdate(document, update, False)
+        if len(found) == 0 and upsert:
+            document = dict()
+            for key, value in query.items():
+                if not key.startswith("$") and not isinstance(value, dict):
+                    setPath(document, key, value)
+            applyUpdate(document, update, True)
+            self.store(document)
+            found = [self.documents[-1]]
+        return found[0] if len(found) > 0 else None
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(self, query or dict(), projection)
+
+    def find_one(self, query=None, projection=None, sort=None):
+        cursor = self.find(query, projection).limit(1)
+        if sort is not None:
+            cursor.sort(sort)
+        documents = list(cursor)
+        return documents[0] if len(documents) > 0 else None
+
+    def insert(self, documents):
+        self.server.roundTrip()
+        if isinstance(documents, list):
+            return [self.store(document) for document in documents]
+        return self.store(documents)
+
+    def update(self, query, update, upsert=False, multi=False):
+        """
+        @return the write result like pymongo 2
+        """
+        self.server.roundTrip()
+        found = len([document for document in self.documents if matches(document, query)])
+        if not multi:
+            found = min(found, 1)
+        self.apply(query, update, upsert, multi)
+        return dict(ok=1, n=max(found, 1 if upsert else 0), updatedExisting=found > 0)
+
+    def remove(self, query):
+        self.server.roundTrip()
+        self.documents = [document for document in self.documents if not matches(document, query)]
+
+    def find_and_modify(self, query, update, upsert=False, new=False):
+        self.server.roundTrip()
+        found = [document for document in self.documents if matches(document, query)]
+        before = copy.deepcopy(found[0]) if len(found) > 0 else None
+        after = self.apply(query, update, upsert, False)
+        return copy.deepcopy(after) if new else before
+
+    def aggregate(self, pipeline):
+        """
+        Run a pipeline of $match and $group stages, $group knows $sum and $max
+        @return the result documents like pymongo 3
+        """
+        self.server.roundTrip()
+        documents = [copy.deepcopy(document) for document in self.documents]
+        for stage in pipeline:
+            if "$match" in stage:
+                documents = [document for document in documents if matches(document, stage["$match"])]
+            elif "$group" in stage:
+                documents = self.__group(documents, stage["$group"])
+            else:
+                raise NotImplementedError("aggregation stage " + list(stage)[0])
+        return documents
+
+    def __group(self, documents, group):
+        def evaluate(expression, document):
+            if isinstance(expression, dict):
+                return dict((key, evaluate(value, document)) for key, value in expression.items() if evaluate(value, document) is not MISSING)
+            if isinstance(expression, str) and expression.startswith("$"):
+                return getPath(document, expression[1:])
+            return expression
+        groups = list()
+        for document in documents:
+            key = evaluate(group["_id"], document)
+            result = next((result for result in groups if result["_id"] == key), None)
+            if result is None:
+                result = dict(_id=key)
+                groups.append(result)
+            for name, accumulator in group.items():
+                if name == "_id":
+                    continue
+                op, expression = list(accumulator.items())[0]
+                value = evaluate(expression, document)
+                if op == "$sum":
+                    result[name] = result.get(name, 0) + value
+                elif op == "$max":
+                    if name not in result or value > result[name]:
+                        result[name] = value
+                else:
+                    raise NotImplementedError("accumulator " + op)
+        return groups
+
+    def create_index(self, keys, **options):
+        self.server.roundTrip()
+        return "_".join("%s_%s" % (key, direction) for key, direction in keys)
+
+    def initialize_ordered_bulk_op(self):
+        return FakeBulk(self)
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self)
+
+class FakeDatabase:
+    """
+    In memory stand-in for a pymongo database
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.__collections = dict()
+
+    def __getitem__(self, name):
+        return self.__collections.setdefault(name, FakeCollection(self.server))
+
+class FakeGridFS:
+    """
+    In memory stand-in for gridfs.GridFS, every method is 1 round trip
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.files = dict()
+
+    def put(self, data, **attributes):
+        self.server.roundTrip()
+        id = ObjectId()
+        self.files[id] = (data, attributes)
+        return id
+
+    def get(self, id):
+        self.server.roundTrip()
+        data, attributes = self.files[id]
+        file = io.BytesIO(data)
+        for key, value in attributes.items():
+            setattr(file, key, value)
+        file._id = id
+        return file
+
+    def delete(self, id):
+        self.server.roundTrip()
+        self.files.pop(id, None)
+
+    def exists(self, id):
+        self.server.roundTrip()
+        return id in self.files
+
+### NEO4J ###
+
+class FakeNode:
+    """
+    Node of the fake graph
+    """
+
+    def __init__(self, id, **properties):
+        self.id = id
+        self.properties = properties
+
+class FakeIndex:
+    """
+    Legacy index of the fake graph
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = dict()
+
+class FakeBatch:
+    """
+    Stand-in for neo4j.WriteBatch, submitting is 1 round trip
+    """
+
+    def __init__(self, graph):
+        self.__graph = graph
+        self.__jobs = list()
+
+    def get_or_create_indexed_node(self, index, key, value, properties=None):
+        graph = self.__graph
+        self.__jobs.append(lambda: graph.getOrCreate(index, key, value, properties))
+
+    def add_indexed_node(self, index, key, value, node):
+        graph = self.__graph
+        self.__jobs.append(lambda: graph.addIndexed(index, value, node))
+
+    def remove_indexed_node(self, index, key=None, value=None, node=None):
+        graph = self.__graph
+        self.__jobs.append(lambda: graph.removeIndexed(index, node))
+
+    def submit(self):
+        self.__graph.server.roundTrip()
+        return [job() for job in self.__jobs]
+
+class FakeGraph:
+    """
+    In process stand-in for the Neo4j REST API, answers the cypher queries of GraphDB_CMS from a simple model of the graph
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.nodes = dict()
+        self.indexes = dict()
+        #documentName -> dict(node, translations: language -> dict(node, contents), attributes, allowed),
+        #the attributes are (owner, key, value) with owner "d" for the document or the language of the translation
+        self.documents = dict()
+        #The data of the chunks by content node id
+        self.chunks = dict()
+        #The text in the content fulltext index by content node id
+        self.fullText = dict()
+        #The number of relationships older versions of saveFile wrote more than once
+        self.duplicates = 0
+        self.__roots = [self.createNode() for i in range(3)]
+
+    def createNode(self, **properties):
+        node = FakeNode(len(self.nodes) + 1, **properties)
+        self.nodes[node.id] = node
+        return node
+
+    def get_index(self, type, name):
+        self.server.roundTrip()
+        return self.indexes.setdefault(name, FakeIndex(name))
+
+    def get_reference_node(self):
+        self.server.roundTrip()
+        return FakeNode(0)
+
+    def getOrCreate(self, index, key, value, properties):
+        node = index.entries.get((key, value))
+        if node is None:
+            node = index.entries[(key, value)] = self.createNode(**(properties or dict()))
+            if index.name == "documents":
+                self.documents[value] = dict(node=node, translations=dict(), attributes=set(), allowed=set())
+        return node
+
+    def addIndexed(self, index, value, node):
+        if index.name == "content":
+            self.fullText[node.id] = value
+
+    def removeIndexed(self, index, node):
+        if index.name == "content":
+            self.fullText.pop(node.id, None)
+
+    def execute(self, query, params):
+        """
+        Answer 1 cypher query
+        @return (rows, columns) like cypher.execute
+        """
+        self.server.roundTrip()
+        if query.startswith("start ref=node(0), d=node({D})"):
+            return self.__save(query, params), None
+        if query.startswith("start ref=node(0) match ref-[:VAL_ROOT]->v,"):
+            return [self.__roots], None
+        if query.startswith("start n=node:documents(documentName={NAME})"):
+            return self.__load(query, params), None
+        if "(n)<-[:ALLOWED]-(u) where u.username={USER} return" in query:
+            document = self.__document(params["ID"])
+            return ([[params["USER"]]] if params["USER"] in document["allowed"] else []), None
+        if query.startswith("start n=node:documents(documentName={DOC})"):
+            language = re.search(r"\(n\)-\[:(\w+)\]->\(l\)", query).group(1)
+            translation = self.documents.get(params["DOC"], dict(translations=dict()))["translations"].get(language)
+            contents = translation["contents"] if translation else list()
+            if "[:CURRENT]->(c)" in query:
+                return [self.__contentRow(query, contents[-1])] if contents else [], None
+            if "[r:HAS_CONTENT]->(c)" in query:
+                versions = list(enumerate(contents))[params["AFTER"] + 1:][:params["LIMIT"]]
+                return [[version] + self.__contentRow(query, content) for version, content in versions], None
+        if query.startswith("start c=node({C}) match c-[r:CHUNK]->k"):
+            return [[data] for data in self.chunks[params["C"]][params["FIRST"]:params["FIRST"] + params["LIMIT"]]], None
+        if query.startswith("start c=node:content({QUERY}), u=node:users(username={USER})"):
+            return self.__searchContent(params), None
+        if query.startswith("start c=node({IDS}) return"):
+            return [[id, self.nodes[id].properties.get("content"), self.nodes[id].properties.get("chunks")] for id in params["IDS"]], None
+        if query.startswith("start vroot=node({ROOT}), v=node({IDS}) create unique"):
+            return [], None
+        if query.startswith('start d=node:documents("documentName:*")'):
+            names = sorted(name for name in self.documents if "AFTER" not in params or name > params["AFTER"])
+            return [[name] for name in names[:params["LIMIT"]]], None
+        if query.startswith("start d=node:documents({QUERY})"):
+            return self.__export(query, params), None
+        if " with distinct d match " in query and "return d.documentName, type(f), fv.value" in query:
+            return self.__facetSearch(query, params), None
+        if query.startswith("start n=node(*) match n-[r]->m"):
+            return ([["DOCUMENT"]] if self.duplicates > 0 else []), None
+        if "foreach (r in tail(rels) : delete r)" in query:
+            self.duplicates = 0
+            return [], None
+        raise NotImplementedError("the fake graph doesn't know " + query)
+
+    def __contentRow(self, query, content):
+        """
+        @return the columns of content the query returns: its content, with its id and chunks when the query asks for them
+        """
+        row = [content.properties.get("content")]
+        if "c.chunks?" in query:
+            row += [content.id, content.properties.get("chunks")]
+        return row
+
+    def __searchContent(self, params):
+        """
+        @return (content id, documentName, language) of the current contents with the word of the lucene query the user is allowed on
+        """
+        word = re.search(r'content:\("(.*)"\)', params["QUERY"]).group(1).lower()
+        rows = list()
+        for name, document in sorted(self.documents.items()):
+            if params["USER"] not in document["allowed"]:
+                continue
+            for language, translation in sorted(document["translations"].items()):
+                if "LANGUAGE" in params and language != params["LANGUAGE"] or not translation["contents"]:
+                    continue
+                content = translation["contents"][-1]
+                if word in self.fullText.get(content.id, "").lower().split():
+                    rows.append([content.id, name, language])
+        return rows[:params["CANDIDATES"]]
+
+    def __export(self, query, params):
+        """
+        @return the rows of the queries of exportDocuments for the documents in the lucene query
+        """
+        names = [re.sub(r"\\(.)", r"\1", name) for name in re.findall(r'"((?:[^"\\]|\\.)*)"', params["QUERY"])]
+        documents = [(name, self.documents[name]) for name in names if name in self.documents]
+        rows = list()
+        if "[r:HAS_CONTENT]->c" in query:
+            #Ordered on the version like the query, the order between documents doesn't matter
+            for name, document in documents:
+                for language, translation in document["translations"].items():
+                    for content in translation["contents"]:
+                        rows.append([name, language, content.properties.get("content"), content.id, content.properties.get("chunks")])
+        elif "d-[l]->t-[r]->v" in query:
+            rows = [[name, owner, key, value] for name, document in documents for owner, key, value in document["attributes"] if owner != "d"]
+        elif "d-[r]->v" in query:
+            rows = [[name, key, value] for name, document in documents for owner, key, value in document["attributes"] if owner == "d"]
+        elif "u-[:ALLOWED]->d" in query:
+            rows = [[name, username] for name, document in documents for username in sorted(document["allowed"])]
+        else:
+            raise NotImplementedError("the fake graph doesn't know " + query)
+        return rows
+
+    def __facetSearch(self, query, params):
+        """
+        @return (documentName, key, value) of all attributes of the documents matching the filters of a facetSearch query
+        """
+        language = re.search(r"d-\[:(\w+)\*0\.\.1\]->", query)
+        owners = ["d"] if language is None else ["d", language.group(1)]
+        matchAll = query.startswith("start v0=")
+        if matchAll:
+            filters = re.findall(r"-\[:(\w+)\]->v(\d+)", query)
+        else:
+            filters = re.findall(r"type\(r\) = '(\w+)' and v\.value in \{V(\d+)\}", query)
+        rows = list()
+        for name, document in sorted(self.documents.items()):
+            attributes = [(key, value) for owner, key, value in document["attributes"] if owner in owners]
+            found = [any((key, value) in attributes for value in params["V" + i]) for key, i in filters]
+            if all(found) if matchAll else any(found):
+                rows += [[name, key, value] for key, value in attributes]
+        return rows
+
+    def __document(self, id):
+        for document in self.documents.values():
+            if document["node"].id == id:
+                return document
+        return None
+
+    def __translation(self, document, language):
+        translation = document["translations"].get(language)
+        if translation is None:
+            translation = document["translations"][language] = dict(node=self.createNode(), contents=list())
+        return translation
+
+    def __save(self, query, params):
+        if self.duplicates > 0:
+            raise RuntimeError("CREATE UNIQUE found more than 1 matching relationship")
+        document = self.__document(params["D"])
+        language = re.search(r"d-\[:(\w+)\]->t", query).group(1)
+        translation = self.__translation(document, language)
+        for owner, key, name in re.findall(r"\b([dt])-\[:(\w+)\]->(v\d+)", query):
+            document["attributes"].add((owner if owner == "d" else language, key, self.nodes[params[name.upper()]].properties["value"]))
+        document["allowed"].add(self.nodes[params["U"]].properties["username"])
+        if "CONTENT" in params:
+            content = self.createNode(content=params["CONTENT"])
+        elif "CHUNKS" in params:
+            content = self.createNode(chunks=params["CHUNKS"])
+            self.chunks[content.id] = [params["CHUNK%d" % i] for i in range(params["CHUNKS"])]
+        else:
+            return [[translation["node"]]]
+        previous = translation["contents"][-1:]
+        translation["contents"].append(content)
+        return [[translation["node"], len(translation["contents"]) - 1, content, previous]]
+
+    def __load(self, query, params):
+        document = self.documents.get(params["NAME"])
+        if document is None:
+            return []
+        language = re.search(r"n-\[\?:(\w+)\]->l", query).group(1)
+        translation = document["translations"].get(language)
+        row = [document["node"], None, None, None]
+        if translation is not None:
+            row[1] = translation["node"]
+            if translation["contents"]:
+                row[2] = len(translation["contents"]) - 1
+                row[3] = translation["contents"][-1].properties.get("content")
+        if "extract(" in query:
+            row.append([[key, value] for owner, key, value in document["attributes"] if owner == "d"])
+        return [row]
+
+class FakeNeo4j:
+    """
+    Makes GraphDB_CMS use a FakeGraph for its cypher queries and batches while it's installed
+    """
+
+    def __init__(self, graph):
+        self.__graph = graph
+        self.__saved = None
+
+    def install(self):
+        graph = self.__graph
+        class Cypher:
+            @staticmethod
+            def execute(connection, query, params=None):
+                return graph.execute(query, params or dict())
+        class Neo4j:
+            Node = object
+            @staticmethod
+            def WriteBatch(connection):
+                return FakeBatch(graph)
+        self.__saved = (GraphDB_CMS.cypher, GraphDB_CMS.neo4j)
+        GraphDB_CMS.cypher, GraphDB_CMS.neo4j = Cypher, Neo4j
+
+    def uninstall(self):
+        GraphDB_CMS.cypher, GraphDB_CMS.neo4j = self.__saved
+
+class FakeConnectionManager(connections.ConnectionManager):
+    """
+    ConnectionManager handing out the fake backends
+    """
+
+    def __init__(self, mongoServer, graphServer):
+        connections.ConnectionManager.__init__(self)
+        self.__database = FakeDatabase(mongoServer)
+        self.__bodies = FakeGridFS(mongoServer)
+        self.__graph = FakeGraph(graphServer)
+
+    def mongoDatabase(self, host, port):
+        return self.__database
+
+    def gridFS(self, host, port):
+        return self.__bodies
+
+    def graph(self, connectionData):
+        return self.__graph
+
+### CORPUS ###
+
+class Corpus:
+    """
+    Synthetic documents for the benchmark, the same seed gives the same corpus
+    """
+
+    WORDS = ["content", "management", "graph", "document", "version", "oracle", "moonfish", "research", "square", "red",
+             "green", "round", "legacy", "new", "title", "organization", "language", "search", "tag", "page"]
+
+    def __init__(self, documents=1000, versions=3, attributes=5, values=3, words=50, users=10, languages=("en",), seed=1):
+        """
+        @param documents the number of documents
+        @param versions the number of versions saved per document
+        @param attributes the number of attributes per document
+        @param values the number of values per attribute
+        @param words the number of words in a body
+        @param users the number of users
+        """
+        self.documents = documents
+        self.versions = versions
+        self.attributes = attributes
+        self.values = values
+        self.words = words
+        self.users = ["user%03d" % i for i in range(users)]
+        self.languages = list(languages)
+        self.random = random.Random(seed)
+
+    def name(self, i):
+        return "doc_%06d" % i
+
+    def text(self):
+        return " ".join(self.random.choice(self.WORDS) for i in range(self.words))
+
+    def attributeValues(self):
+        """
+        @return list of (key, values) for 1 document
+        """
+        return [("attribute%d" % a, self.random.sample(self.WORDS, self.values)) for a in range(self.attributes)]
+
+    def user(self, i):
+        return self.users[i % len(self.users)]
+
+    def items(self):
+        """
+        @return generator with (name, language, user, version) for all versions of all documents
+        """
+        for version in range(self.versions):
+            for i in range(self.documents):
+                for language in self.languages:
+                    yield self.name(i), language, self.user(i), version
+
+### HARNESS ###
+
+def measure(name, server, calls):
+    """
+    Run the calls and measure them
+    @param calls list of functions without arguments, each is 1 operation
+    @return dict with the throughput, latency percentiles and round trips per operation
+    """
+    requests = server.requests
+    latencies = list()
+    start = time.time()
+    for call in calls:
+        begin = time.time()
+        call()
+        latencies.append(time.time() - begin)
+    seconds = time.time() - start
+    latencies.sort()
+    percentile = lambda fraction: latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] if latencies else 0.0
+    return dict(operation=name, calls=len(calls), throughput=len(calls) / seconds if seconds > 0 else 0.0,
+                p50=percentile(0.5), p95=percentile(0.95), p99=percentile(0.99),
+                roundTrips=float(server.requests - requests) / len(calls) if calls else 0.0)
+
+def benchmarkMongo(corpus, latency=0.0):
+    """
+    Benchmark save, getLastByURI and getBySearch of documentStore
+    @return list with the result of measure per operation
+    """
+    server = FakeServer(latency)
+    store = documentStore.DocumentStore("fake", 0, connectionManager=FakeConnectionManager(server, FakeServer()))
+    for username in corpus.users:
+        user = documentStore.User(username)
+        user.addGroup("public", ["r", "w"])
+        store.createUser(user)
+    results = list()
+    saves = list()
+    for name, language, user, version in corpus.items():
+        body = dict(text=corpus.text(), attributes=dict(corpus.attributeValues()))
+        saves.append(lambda name=name, language=language, user=user, body=body: store.save(documentStore.Document(body, name, language, user, ["public"])))
+    results.append(measure("save", server, saves))
+    lookups = [lambda i=i: store.getLastByURI(corpus.name(i), corpus.languages[0]) for i in range(corpus.documents)]
+    results.append(measure("getLastByURI", server, lookups))
+    searches = [lambda i=i: list(store.getBySearch(corpus.user(i), {"metadata.uri": corpus.name(i)}, corpus.languages[0])) for i in range(min(corpus.documents, 100))]
+    results.append(measure("getBySearch", server, searches))
+    return results
+
+def benchmarkGraph(corpus, latency=0.0):
+    """
+    Benchmark Document.saveFile, checkPermission and getDocumentContent of GraphDB_CMS
+    @return list with the result of measure per operation
+    """
+    server = FakeServer(latency)
+    manager = FakeConnectionManager(FakeServer(), server)
+    fake = FakeNeo4j(manager.graph(None))
+    fake.install()
+    try:
+        GraphDB_CMS.VALUE_NODES.clear()
+        store = GraphDB_CMS.DocumentStore("fake", connectionManager=manager)
+        results = list()
+        def save(name, language, user):
+            #Loading the document is part of saving it, new documents print a message
+            with contextlib.redirect_stdout(io.StringIO()):
+                document = store.createDocument(name, language.upper())
+            for key, values in corpus.attributeValues():
+                for value in values:
+                    document.addAttribute(key, value)
+            document.addContent(corpus.text())
+            document.saveFile(user)
+        saves = [lambda item=item: save(*item[:3]) for item in corpus.items()]
+        results.append(measure("saveFile", server, saves))
+        documents = [store.createDocument(corpus.name(i), corpus.languages[0].upper(), lazy=True) for i in range(corpus.documents)]
+        checks = [lambda i=i: documents[i].checkPermission(corpus.user(i)) for i in range(corpus.documents)]
+        results.append(measure("checkPermission", server, checks))
+        contents = [lambda i=i: store.getDocumentContent(corpus.name(i), corpus.languages[0].upper()) for i in range(corpus.documents)]
+        results.append(measure("getDocumentContent", server, contents))
+        return results
+    finally:
+        fake.uninstall()
+
+def report(backend, results):
+    """
+    Print the results of a backend as a table
+    """
+    print("%s" % backend)
+    print("%-20s %8s %12s %10s %10s %10s %12s" % ("operation", "calls", "ops/s", "p50 ms", "p95 ms", "p99 ms", "round trips"))
+    for result in results:
+        print("%-20s %8d %12.1f %10.3f %10.3f %10.3f %12.2f" % (result["operation"], result["calls"], result["throughput"],
+              result["p50"] * 1000, result["p95"] * 1000, result["p99"] * 1000, result["roundTrips"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the MongoDB and Neo4j CMS stores")
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--versions", type=int, default=3)
+    parser.add_argument("--attributes", type=int, default=5)
+    parser.add_argument("--values", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every round trip")
+    parser.add_argument("--backend", choices=["mongo", "neo4j", "all"], default="all")
+    args = parser.parse_args()
+    corpus = lambda: Corpus(args.documents, args.versions, args.attributes, args.values)
+    if args.backend in ("mongo", "all"):
+        report("MongoDB", benchmarkMongo(corpus(), args.latency))
+    if args.backend in ("neo4j", "all"):
+        report("Neo4j", benchmarkGraph(corpus(), args.latency))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+from collections import OrderedDict
+import threading
+import time
+
+class LRUCache:
+    """
+    In process cache with a bounded size, least recently used eviction and an optional time to live
+    Safe to share between threads
+    """
+
+    def __init__(self, size=1024, ttl=None):
+        """
+        @param size the maximum number of entries, the least recently used entry is evicted when it's full
+        @param ttl the number of seconds an entry stays valid, None to keep entries until they are evicted
+        """
+        self.__size = size
+        self.__ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    @property
+    def size(self):
+        """
+        @return the maximum number of entries
+        """
+        return self.__size
+
+    @property
+    def ttl(self):
+        """
+        @return the time to live of an entry in seconds
+        """
+        return self.__ttl
+
+    @property
+    def hits(self):
+        """
+        @return the number of lookups that were found in the cache
+        """
+        return self.__hits
+
+    @property
+    def misses(self):
+        """
+        @return the number of lookups that were not found or expired
+        """
+        return self.__misses
+
+    @property
+    def evictions(self):
+        """
+        @return the number of entries removed to make room for new ones
+        """
+        return self.__evictions
+
+    @property
+    def stats(self):
+        """
+        @return the counters of the cache as a dict
+        """
+        return dict(hits=self.__hits, misses=self.__misses, evictions=self.__evictions, entries=len(self.__entries), size=self.__size)
+
+    def get(self, key, default=None):
+        """
+        @return the value cached for key or default when it's not cached or expired
+        """
+        with self.__lock:
+            entry = self.__entry(key)
+            if entry is None:
+                self.__misses += 1
+                return default
+            self.__hits += 1
+            #Moving the entry to the end marks it as most recently used
+            value = self.__entries.pop(key)
+            self.__entries[key] = value
+            return value[0]
+
+    def put(self, key, value):
+        """
+        Cache value for key, evicting the least recently used entry when the cache is full
+        """
+        with self.__lock:
+            self.__put(key, value)
+        
+    def putIf(self, key, value, condition):
+        """
+        Cache value for key when condition allows it, no other put can come between the check and the put
+        @param condition function getting the value cached for key (None when it's not cached or expired), True to replace it
+        @return True when value was cached
+        """
+        with self.__lock:
+            entry = self.__entry(key)
+            if not condition(None if entry is None else entry[0]):
+                return False
+            self.__put(key, value)
+            return True
+        
+    def __entry(self, key):
+        """
+        @return the (value, time) entry for key or None when it's not cached or expired, call with the lock
+        """
+        entry = self.__entries.get(key)
+        if entry is not None and self.__ttl is not None and time.time() - entry[1] > self.__ttl:
+            del self.__entries[key]
+            entry = None
+        return entry
+        
+    def __put(self, key, value):
+        """
+        Cache value for key, call with the lock
+        """
+        self.__entries.pop(key, None)
+        self.__entries[key] = (value, time.time())
+        while len(self.__entries) > self.__size:
+            self.__entries.popitem(last=False)
+            self.__evictions += 1
+
+    def invalidate(self, key):
+        """
+        Remove key from the cache
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries, the counters are kept
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
@@ -0,0 +1,123 @@
+import threading
+
+class ConnectionManager:
+    """
+    Shares the MongoDB clients and Neo4j services between all stores in the process
+    so creating a store doesn't create connections, the pools of the clients are reused
+    """
+
+    #The default names of the MongoDB collections by store attribute
+    COLLECTIONS = dict(collection="cms.nodes", ctxCollection="csm.context", counterCollection="cms.counters", blobCollection="cms.blobs",
+                       archiveCollection="cms.archive", checkpointCollection="cms.checkpoints",
+                       bodyCollection="cms.bodies")
+
+    def __init__(self, maxPoolSize=100, connectTimeout=20000, socketTimeout=None, waitQueueTimeout=None, database="test_database", collections=None):
+        """
+        @param maxPoolSize the maximum number of connections per MongoDB client
+        @param connectTimeout the milliseconds to wait for a new MongoDB connection
+        @param socketTimeout the milliseconds to wait for a MongoDB answer, None to wait forever
+        @param waitQueueTimeout the milliseconds to wait for a free connection when the pool is full, None to wait forever
+        @param database the name of the MongoDB database
+        @param collections dict with the collection names to use instead of those in COLLECTIONS
+        """
+        self.maxPoolSize = maxPoolSize
+        self.connectTimeout = connectTimeout
+        self.socketTimeout = socketTimeout
+        self.waitQueueTimeout = waitQueueTimeout
+        self.database = database
+        self.collections = dict(self.COLLECTIONS)
+        self.collections.update(collections or dict())
+        self.__lock = threading.Lock()
+        self.__clients = dict()
+        self.__graphs = dict()
+        self.__handles = dict()
+        self.__gridFS = dict()
+        self.__shared = dict()
+
+    def mongoClient(self, host, port):
+        """
+        @return the shared MongoClient for host:port, created the first time
+        """
+        key = (host, port)
+        client = self.__clients.get(key)
+        if client is None:
+            with self.__lock:
+                client = self.__clients.get(key)
+                if client is None:
+                    #Imported here so the Neo4j store doesn't need pymongo
+                    from pymongo import MongoClient
+                    client = MongoClient(host, port, maxPoolSize=self.maxPoolSize, connectTimeoutMS=self.connectTimeout,
+                                         socketTimeoutMS=self.socketTimeout, waitQueueTimeoutMS=self.waitQueueTimeout)
+                    self.__clients[key] = client
+        return client
+
+    def mongoDatabase(self, host, port):
+        """
+        @return the configured database on the shared client for host:port
+        """
+        return self.mongoClient(host, port)[self.database]
+
+    def gridFS(self, host, port):
+        """
+        @return the shared GridFS of the bodyCollection in the configured database on host:port, created the first time
+        """
+        key = (host, port)
+        bodies = self.__gridFS.get(key)
+        if bodies is None:
+            database = self.mongoDatabase(host, port)
+            with self.__lock:
+                bodies = self.__gridFS.get(key)
+                if bodies is None:
+                    #Imported here as only stores with large bodies need GridFS
+                    import gridfs
+                    bodies = gridfs.GridFS(database, self.collections["bodyCollection"])
+                    self.__gridFS[key] = bodies
+        return bodies
+
+    def graph(self, connectionData):
+        """
+        @return the shared GraphDatabaseService for connectionData, its requests reuse keep-alive HTTP connections
+        """
+        graph = self.__graphs.get(connectionData)
+        if graph is None:
+            with self.__lock:
+                graph = self.__graphs.get(connectionData)
+                if graph is None:
+                    #Imported here so the MongoDB store doesn't need py2neo
+                    from py2neo import neo4j
+                    graph = neo4j.GraphDatabaseService(connectionData)
+                    self.__graphs[connectionData] = graph
+        return graph
+
+    def graphHandles(self, connectionData):
+        """
+        @return the dict in which the stores for connectionData keep their root nodes and indexes
+        """
+        with self.__lock:
+            return self.__handles.setdefault(connectionData, dict())
+
+    def shared(self, key, factory):
+        """
+        @return the object all stores of the manager share under key (e.g. a cache), factory is called to create it the first time
+        """
+        with self.__lock:
+            value = self.__shared.get(key)
+            if value is None:
+                value = self.__shared[key] = factory()
+            return value
+
+    def close(self):
+        """
+        Close the MongoDB clients and forget all connections
+        """
+        with self.__lock:
+            for client in self.__clients.values():
+                client.close()
+            self.__clients = dict()
+            self.__graphs = dict()
+            self.__handles = dict()
+            self.__gridFS = dict()
+            self.__shared = dict()
+
+#The manager used by stores that don't get one
+default = ConnectionManager()
@@ -1,6 +1,16 @@
 import pymongo
-from pymongo import MongoClient
-from datetime import datetime
+from bson.objectid import ObjectId
+from collections import deque
+from datetime import datetime, timedelta
+from cache import LRUCache
+import connections
+import copy
+from instrumentation import instrumented, instrumentedAs, InstrumentedProxy, InstrumentedCursor
+import gzip
+import hashlib
+import io
+import json
+import time
 from pprint import pprint
 
 class Document:
@@ -9,29 +19,29 @@ class Document:
     """
     
     def __init__(self, doc, uri, language, user, groups):
-		"""
-		@param doc the document which can be a structure itself
-		@param uri The name of the document
-		@param language The language you want the document to be in
-		@param user the user that is creating the file
-		@param groups the security groups for this document
-		"""
+        """
+        @param doc the document which can be a structure itself
+        @param uri The name of the document
+        @param language The language you want the document to be in
+        @param user the user that is creating the file
+        @param groups the security groups for this document
+        """
         self.__json = doc
         self.uri = uri
         self.__metadata = dict(createdate=datetime.utcnow(), creator=user, active=True, uri=self.uri, language=language, groups=groups)
         
     @property
     def document(self):
-		"""
-		Get the json of the document (not the metadata)
-		"""
+        """
+        Get the json of the document (not the metadata)
+        """
         return self.__json
         
     @property
     def metadata(self):
-		"""
-		Get the metadata of the document (not the document itslef)
-		"""
+        """
+        Get the metadata of the document (not the document itslef)
+        """
         return self.__metadata
         
 class User:
@@ -40,9 +50,9 @@ class User:
     """
     
     def __init__(self, user):
-		"""
-		@param user The username
-		"""
+        """
+        @param user The username
+        """
         if type(user) == str:
             self.__username = user
             self.__groups = list()
@@ -52,32 +62,109 @@ class User:
     
     @property
     def username(self):
-		"""
-		@return the username
-		"""
+        """
+        @return the username
+        """
         return self.__username
         
     @property
     def groups(self):
-		"""
-		@param the groups this user is part of
-		"""
+        """
+        @param the groups this user is part of
+        """
         return self.__groups
         
     @property
     def document(self):
-		"""
-		@return the document  that reprsents the user (document as in mongodb document store)
-		"""
+        """
+        @return the document  that reprsents the user (document as in mongodb document store)
+        """
         return dict(groups=self.__groups, username=self.__username)
         
     def addGroup(self, group, permissions):
-		"""
-		add a group with permissions to the user
-		"""
+        """
+        add a group with permissions to the user
+        """
         current = {"groupname":group, "permissions":permissions}
         self.__groups.append(current)
     
+class SeenChanges:
+    """
+    The changes of 1 stream of getChanges ("saved" or "deactivated") handled in the window before the newest one,
+    kept in the order they were handled so forgetting the old ones only looks at the oldest
+    A saved change is kept as its _id, a deactivated one as [deactivated, _id] as they are stored in the checkpoint
+    """
+    
+    def __init__(self, change, checkpoint, window, maxSeen):
+        """
+        @param checkpoint the getChanges checkpoint with all fields
+        @param window the timedelta a change can be late
+        @param maxSeen the maximum number of kept changes, older ones are forgotten and no longer read again
+        """
+        self.change = change
+        self.window = window
+        self.maxSeen = maxSeen
+        self.newest = checkpoint[change]
+        self.entries = deque(checkpoint[change + "Seen"])
+        #The key from which changes are read again when more than maxSeen were handled in the window
+        self.first = checkpoint[change + "From"]
+        
+    def key(self, entry):
+        """
+        @return the _id of a saved change, the deactivation time of a deactivated one
+        """
+        return entry if self.change == "saved" else entry[0]
+        
+    def ids(self):
+        """
+        @return the _ids of the kept changes
+        """
+        if self.change == "saved":
+            return list(self.entries)
+        return [entry[1] for entry in self.entries]
+        
+    def start(self):
+        """
+        @return the key from which the changes are read again, None to read all changes
+        """
+        if self.newest is None:
+            return None
+        start = self.__windowStart()
+        if self.first is not None and self.first > start:
+            return self.first
+        return start
+        
+    def add(self, entry):
+        """
+        Keep the handled change entry, the changes before the window or beyond maxSeen are forgotten
+        """
+        self.entries.append(entry)
+        key = self.key(entry)
+        if self.newest is None or key > self.newest:
+            self.newest = key
+            start = self.__windowStart()
+            while self.key(self.entries[0]) < start:
+                self.entries.popleft()
+        if len(self.entries) > self.maxSeen:
+            self.entries.popleft()
+            self.first = self.key(self.entries[0])
+        
+    def store(self, checkpoint):
+        """
+        Put the kept changes in checkpoint, as new lists so the checkpoints given out earlier stay as they were
+        """
+        checkpoint[self.change] = self.newest
+        checkpoint[self.change + "Seen"] = list(self.entries)
+        checkpoint[self.change + "From"] = self.first
+        
+    def __windowStart(self):
+        """
+        @return the key window before the newest change
+        """
+        if self.change == "saved":
+            return ObjectId.from_datetime(self.newest.generation_time - self.window)
+        return self.newest - self.window
+    
 class DocumentStore:
     """
     Class that handles all communication with the MongoDB
@@ -85,46 +172,491 @@ class DocumentStore:
     The "CMS"
     """
     
-    def __init__(self, host, port):
-		"""
-		Create connection to host:port
-		"""
-        connection = MongoClient(host,port )
-        self.db = connection.test_database
-        self.collection = self.db.cms.nodes
-        self.ctxCollection = self.db.csm.context
-        
-    def getAllByURI(self, uri, language):
-		"""
-		Get all documents for uri by language
-		"""
-        results = self.collection.find({"metadata.uri":uri}).sort('metadata.version', pymongo.ASCENDING)
+    #The indexes needed by the queries of the store as (collection attribute, keys, options)
+    INDEXES = [
+        #getLastByURI, getTranslations and the deactivation of old versions in save
+        ("collection", [("metadata.uri", pymongo.ASCENDING), ("metadata.language", pymongo.ASCENDING), ("metadata.active", pymongo.ASCENDING), ("metadata.version", pymongo.ASCENDING)], {}),
+        #getAllByURI
+        ("collection", [("metadata.uri", pymongo.ASCENDING), ("metadata.language", pymongo.ASCENDING), ("metadata.version", pymongo.ASCENDING)], {}),
+        #getBySearch and the pages of getSearchPage
+        ("collection", [("metadata.active", pymongo.ASCENDING), ("metadata.language", pymongo.ASCENDING), ("metadata.groups", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], {}),
+        #getUser
+        ("ctxCollection", [("username", pymongo.ASCENDING)], {"unique": True}),
+        #compact
+        ("collection", [("metadata.active", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], {}),
+        #the deactivations of getChanges
+        ("collection", [("metadata.deactivated", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], {"sparse": True}),
+        #getAllByURI with archived
+        ("archiveCollection", [("metadata.uri", pymongo.ASCENDING), ("metadata.language", pymongo.ASCENDING), ("metadata.version", pymongo.ASCENDING)], {}),
+    ]
+    
+    #The text index of searchText, only built with fullText, active as prefix so only active versions are searched
+    TEXT_INDEXES = [
+        ("collection", [("metadata.active", pymongo.ASCENDING), ("text", pymongo.TEXT)], {"default_language": "none"}),
+    ]
+    
+    #The GridFS methods that do a round trip, a file opened by get counts every read
+    BODY_OPERATIONS = ["put", "get", "delete", "exists"]
+    
+    #The collection attributes of the store
+    COLLECTIONS = ["collection", "ctxCollection", "counterCollection", "blobCollection", "archiveCollection", "checkpointCollection"]
+    
+    #The collection methods that do a round trip, the batches of a cursor of find are counted when they're read
+    OPERATIONS = ["find_one", "insert", "update", "remove", "find_and_modify", "aggregate", "create_index", "count"]
+    
+    def __init__(self, host, port, userCacheSize=1024, userCacheTTL=300, ensureIndexes=False, dedupe=False, deltaThreshold=None, documentCache=None, validateCache=False, connectionManager=None, fullText=False, keepVersions=None, maxAge=None, largeThreshold=None):
+        """
+        Create connection to host:port
+        @param userCacheSize the number of users (and their roles) kept in memory
+        @param userCacheTTL the number of seconds a cached user stays valid
+            the user caches are shared by all stores of the connectionManager for host:port, the first store sets their size and TTL
+        @param ensureIndexes build the indexes in INDEXES when the store is created
+        @param dedupe store every unique document body once in cms.blobs, versions only point to the hash of their body
+            (getBySearch can then only search on the metadata)
+        @param deltaThreshold with dedupe, bodies bigger than this number of bytes are stored by save as the changes against the body of the previous version,
+            saveMany always stores complete bodies as a delta needs the previous body which would cost reads per document
+        @param documentCache cache for getLastByURI with the get, putIf and invalidate methods of LRUCache, None to always read from MongoDB
+        @param validateCache check that no newer version of a cached document is active before using it,
+            this costs a small lookup but never returns a version replaced by another process
+        @param connectionManager the ConnectionManager with the shared client and the database and collection names, None for connections.default
+        @param fullText store the text of the document bodies with every version for searchText
+        @param keepVersions the number of newest versions per uri and language compact leaves in the collection, None for no limit
+        @param maxAge the number of seconds compact leaves versions in the collection, None for no limit
+            a version stays when keepVersions or maxAge keeps it, active versions always stay
+        @param largeThreshold bodies bigger than this number of bytes are stored in chunks in GridFS instead of in the version,
+            read them in parts with openBody, None to keep all bodies in the versions (at most 16MB)
+            versions with large bodies can be read whatever largeThreshold is
+            with fullText only the first largeThreshold characters of the text of a large body are searched
+        """
+        if connectionManager is None:
+            connectionManager = connections.default
+        self.connectionManager = connectionManager
+        self.host = host
+        self.port = port
+        self.db = connectionManager.mongoDatabase(host, port)
+        for name in self.COLLECTIONS:
+            setattr(self, name, self.db[connectionManager.collections[name]])
+        self.dedupe = dedupe
+        self.deltaThreshold = deltaThreshold
+        self.documentCache = documentCache
+        self.validateCache = validateCache
+        self.fullText = fullText
+        self.keepVersions = keepVersions
+        self.maxAge = maxAge
+        self.largeThreshold = largeThreshold
+        self.instrumentation = None
+        self.userCache = connectionManager.shared(("userCache", host, port), lambda: LRUCache(userCacheSize, userCacheTTL))
+        self.roleCache = connectionManager.shared(("roleCache", host, port), lambda: LRUCache(userCacheSize, userCacheTTL))
+        if ensureIndexes:
+            self.ensureIndexes()
+        
+    @property
+    def bodies(self):
+        """
+        The GridFS with the large bodies, only created when a large body is written or read
+        """
+        bodies = self.connectionManager.gridFS(self.host, self.port)
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return bodies
+        body = lambda file: InstrumentedProxy(file, instrumentation, "mongo", ["read", "readchunk", "readline"])
+        return InstrumentedProxy(bodies, instrumentation, "mongo", self.BODY_OPERATIONS, dict(get=body))
+        
+    def enableInstrumentation(self, instrumentation):
+        """
+        Count the calls of this store and the MongoDB round trips they do in instrumentation
+        """
+        self.disableInstrumentation()
+        self.instrumentation = instrumentation
+        bulk = lambda operation: InstrumentedProxy(operation, instrumentation, "mongo", ["execute"])
+        cursor = lambda cursor: InstrumentedCursor(cursor, instrumentation, "mongo", "find")
+        wrappers = dict(initialize_ordered_bulk_op=bulk, initialize_unordered_bulk_op=bulk, find=cursor)
+        for name in self.COLLECTIONS:
+            setattr(self, name, InstrumentedProxy(getattr(self, name), instrumentation, "mongo", self.OPERATIONS, wrappers))
+        
+    def disableInstrumentation(self):
+        """
+        Stop counting calls and round trips
+        """
+        self.instrumentation = None
+        for name in self.COLLECTIONS:
+            collection = getattr(self, name)
+            if isinstance(collection, InstrumentedProxy):
+                setattr(self, name, collection.target)
+        
+    @instrumented
+    def ensureIndexes(self):
+        """
+        Build the indexes in INDEXES (and TEXT_INDEXES with fullText), indexes that already exist are left alone
+        @return the names of the indexes
+        """
+        names = list()
+        indexes = self.INDEXES
+        if self.fullText:
+            indexes = indexes + self.TEXT_INDEXES
+        for collection, keys, options in indexes:
+            names.append(getattr(self, collection).create_index(keys, **options))
+        return names
+        
+    @instrumented
+    def checkQueryPlans(self):
+        """
+        Run explain on the queries of the store to find queries that need a collection scan
+        @return a list with dict(name, collectionScan, plan) per query
+        """
+        queries = [
+            ("getLastByURI", self.collection.find(self.__uriQuery("", "", True)).sort('metadata.version', pymongo.DESCENDING).limit(1)),
+            ("getAllByURI", self.collection.find(self.__uriQuery("", "")).sort('metadata.version', pymongo.ASCENDING)),
+            ("getTranslations", self.collection.find(self.__uriQuery("", {"$in": ["", ""]}, True))),
+            ("getBySearch", self.collection.find(self.__searchFilter(['public'], None, ""))),
+            ("getSearchPage", self.collection.find(self.__searchFilter(['public'], None, "", ObjectId())).sort('_id', pymongo.ASCENDING).limit(1)),
+            ("save", self.collection.find(self.__deactivateQuery("", "", 0))),
+            ("compact", self.collection.find(self.__compactQuery(ObjectId())).sort('_id', pymongo.ASCENDING).limit(1)),
+            ("getUser", self.ctxCollection.find({"username":""}).limit(1)),
+        ]
+        report = list()
+        for name, cursor in queries:
+            plan = cursor.explain()
+            report.append(dict(name=name, collectionScan=self.__isCollectionScan(plan), plan=plan))
+        return report
+        
+    def __isCollectionScan(self, plan):
+        """
+        @return True when the explain output contains a collection scan (BasicCursor on old servers)
+        """
+        if isinstance(plan, dict):
+            if plan.get("stage") == "COLLSCAN" or plan.get("cursor") == "BasicCursor":
+                return True
+            return any(self.__isCollectionScan(value) for value in plan.values())
+        if isinstance(plan, list):
+            return any(self.__isCollectionScan(value) for value in plan)
+        return False
+        
+    @instrumented
+    def getAllByURI(self, uri, language, archived=False):
+        """
+        Get all documents for uri by language
+        @param language None for all languages
+        @param archived also get the versions compact moved to the archive
+        """
+        results = self.collection.find(self.__uriQuery(uri, language)).sort('metadata.version', pymongo.ASCENDING)
         l = list(results)
-        return l
+        if archived:
+            l.extend(self.archiveCollection.find(self.__uriQuery(uri, language)))
+            l.sort(key=lambda record: record["metadata"]["version"])
+        return self.__loadBodies(l)
         
-    def getLastByURI(self, uri, language):
-		"""
-		Get latest version of document for uri by language
-		"""
-        result = self.collection.find_one({"metadata.uri":uri, "metadata.active":True})
+    def iterAllByURI(self, uri, language, fields=None, batchSize=100):
+        """
+        Stream all documents for uri by language without loading the whole history in memory
+        @param fields the fields to return e.g. ["metadata"], None for the complete documents
+        @param batchSize the number of documents fetched per round trip
+        @return generator with the versions in ascending order
+        """
+        results = self.collection.find(self.__uriQuery(uri, language), self.__projection(fields)).sort('metadata.version', pymongo.ASCENDING)
+        return self.__iterLoaded(results, batchSize)
+        
+    def __iterLoaded(self, cursor, batchSize):
+        """
+        Stream the records of cursor with their bodies loaded per batch of batchSize records
+        @return generator with the records in the order of cursor
+        """
+        batch = list()
+        for result in cursor.batch_size(batchSize):
+            batch.append(result)
+            if len(batch) >= batchSize:
+                for document in self.__loadBodies(batch):
+                    yield document
+                batch = list()
+        for document in self.__loadBodies(batch):
+            yield document
+        
+    def __uriQuery(self, uri, language, active=None):
+        """
+        @return the query for the versions of uri in language
+        @param language None for all languages
+        @param active True or False to get only the active or inactive versions
+        """
+        query = {"metadata.uri":uri}
+        if language is not None:
+            query["metadata.language"] = language
+        if active is not None:
+            query["metadata.active"] = active
+        return query
+        
+    def __projection(self, fields):
+        """
+        @return the projection for the list of fields, None for the complete document
+        """
+        if fields is None:
+            return None
+        projection = dict((field, True) for field in fields)
+        #With dedupe the body is found through the blob hash, large bodies through the GridFS id
+        if "document" in projection:
+            projection["blob"] = True
+            projection["body"] = True
+        return projection
+        
+    @instrumented
+    def getLastByURI(self, uri, language, fields=None):
+        """
+        Get latest version of document for uri by language
+        The result comes from the documentCache when there is one, as a copy so callers can't change the cached document
+        @param fields the fields to return e.g. ["metadata"] to leave out the body, None for the complete document
+        """
+        if fields is not None:
+            result = self.collection.find_one(self.__uriQuery(uri, language, True), self.__projection(fields), sort=[('metadata.version', pymongo.DESCENDING)])
+            if result is not None:
+                result = self.__loadBodies([result])[0]
+            return result
+        if self.documentCache is not None:
+            result = self.documentCache.get((uri, language))
+            if result is not None and (not self.validateCache or self.__isLatest(result)):
+                return copy.deepcopy(result)
+        #Sorting on version so a version that lost a concurrent save race never hides the newest one
+        result = self.collection.find_one(self.__uriQuery(uri, language, True), sort=[('metadata.version', pymongo.DESCENDING)])
+        if result is not None:
+            result = self.__loadBodies([result])[0]
+            #Large bodies would fill the memory of the cache
+            if self.documentCache is not None and "body" not in result:
+                self.__cacheDocument(result)
         return result
+        
+    def __cacheDocument(self, record):
+        """
+        Put a copy of record in the documentCache unless a newer version is cached, the check and the put are atomic
+        so concurrent saves and reads can't leave an older version in the cache
+        """
+        metadata = record["metadata"]
+        version = metadata["version"]
+        newer = lambda cached: cached is None or cached["metadata"]["version"] < version
+        self.documentCache.putIf((metadata["uri"], metadata["language"]), copy.deepcopy(record), newer)
+        
+    @instrumented
+    def getTranslations(self, uri, languages, fields=None):
+        """
+        Get the latest version of uri in a lot of languages with 1 query
+        @param fields the fields to return e.g. ["metadata"], None for the complete documents
+        @return dict with the document per language, languages without a version are left out
+        """
+        translations = dict()
+        projection = self.__projection(fields)
+        if projection is not None and "metadata" not in projection:
+            projection["metadata.language"] = True
+        results = self.collection.find(self.__uriQuery(uri, {"$in": list(languages)}, True), projection).sort('metadata.version', pymongo.DESCENDING)
+        for result in results:
+            #The highest version comes first
+            language = result["metadata"]["language"]
+            if language not in translations:
+                translations[language] = result
+        self.__loadBodies(list(translations.values()))
+        return translations
+        
+    def invalidateDocument(self, uri, language):
+        """
+        Remove uri in language from the documentCache, for documents saved by other processes
+        """
+        if self.documentCache is not None:
+            self.documentCache.invalidate((uri, language))
+        
+    def __isLatest(self, record):
+        """
+        @return True when no newer version of record is active, with 1 lookup on the uri index
+        Versions only become active when they are written, a reserved version of a save that failed doesn't count
+        """
+        metadata = record["metadata"]
+        query = self.__uriQuery(metadata["uri"], metadata["language"], True)
+        query["metadata.version"] = {"$gt": metadata["version"]}
+        return self.collection.find_one(query, {"_id": True}) is None
     
     def showAll(self):
         cur = self.collection.find()
         for item in cur:
             pprint(item)
         
-    def getBySearch(self, username, search=None, language=None):
-		"""
-		Search as username for the searchstring and return only in language
-		"""
-        #We are only interested in active data
-        searchString = [{"metadata.active":True}]
+    def getChanges(self, checkpoint=None, batchSize=1000, fields=None, window=60, maxSeen=1000):
+        """
+        Stream the versions saved and deactivated since checkpoint, first the saved ones in _id order
+        then the deactivated ones in order of deactivation, only batchSize versions are in memory
+        The ids and deactivation times come from the clocks of the writers and a write can become visible after newer ones,
+        so the versions of the last window seconds before the checkpoint are read again and those in the checkpoint are skipped
+        Versions compact moved to the archive are not in the changes
+        @param checkpoint the checkpoint of the last change handled by an earlier call, None to get all changes
+        @param fields the fields to return e.g. ["metadata"], None for the complete documents
+        @param window the seconds a change can be late, more than the clock difference between the writers plus the time a write takes,
+            the checkpoint keeps the ids of the changes handled in the last window seconds
+        @param maxSeen the maximum number of ids per stream in the checkpoint, when more changes were handled in the window
+            (e.g. by a saveMany) only the changes after the oldest kept one are read again so a late write before it is missed
+        @return generator with (change, document, checkpoint) where change is "saved" or "deactivated",
+            store checkpoint (e.g. with saveCheckpoint) to resume after document
+        """
+        checkpoint = self.__checkpoint(checkpoint)
+        window = timedelta(seconds=window)
+        for change in ("saved", "deactivated"):
+            seen = SeenChanges(change, checkpoint, window, maxSeen)
+            after = None
+            while True:
+                documents = self.__changesPage(seen, after, batchSize, fields)
+                for document in documents:
+                    if change == "saved":
+                        after = document["_id"]
+                        seen.add(after)
+                    else:
+                        after = (document["metadata"]["deactivated"], document["_id"])
+                        seen.add(list(after))
+                    seen.store(checkpoint)
+                    yield change, document, dict(checkpoint)
+                if len(documents) < batchSize:
+                    break
+        
+    def __checkpoint(self, checkpoint):
+        """
+        @return a copy of the getChanges checkpoint with all fields, None for the checkpoint before all changes
+        """
+        checkpoint = dict(checkpoint or dict())
+        for change in ("saved", "deactivated"):
+            checkpoint.setdefault(change, None)
+            checkpoint.setdefault(change + "From", None)
+            checkpoint[change + "Seen"] = list(checkpoint.get(change + "Seen", list()))
+        #Older checkpoints have (deactivated, _id) and no seen changes
+        if isinstance(checkpoint["deactivated"], (list, tuple)):
+            checkpoint["deactivated"] = checkpoint["deactivated"][0]
+        return checkpoint
+        
+    @instrumentedAs("getChanges")
+    def __changesPage(self, seen, after, batchSize, fields):
+        """
+        @return the next batchSize versions of the stream of seen after the version with key after in this call,
+        or for the first page from the start of seen, the versions in seen are left out
+        """
+        projection = self.__projection(fields)
+        start = seen.start()
+        if seen.change == "saved":
+            ids = dict()
+            if after is not None:
+                ids["$gt"] = after
+            elif start is not None:
+                ids["$gte"] = start
+            if len(seen.entries) > 0:
+                ids["$nin"] = seen.ids()
+            query = {"_id": ids} if len(ids) > 0 else dict()
+            sort = [('_id', pymongo.ASCENDING)]
+        else:
+            if projection is not None:
+                projection["metadata.deactivated"] = True
+            query = {"metadata.deactivated": {"$exists": True}}
+            if after is not None:
+                deactivated, id = after
+                query = {"$or": [{"metadata.deactivated": {"$gt": deactivated}}, {"metadata.deactivated": deactivated, "_id": {"$gt": id}}]}
+            elif start is not None:
+                query = {"metadata.deactivated": {"$gte": start}}
+            if len(seen.entries) > 0:
+                query["_id"] = {"$nin": seen.ids()}
+            sort = [('metadata.deactivated', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+        documents = list(self.collection.find(query, projection).sort(sort).limit(batchSize))
+        return self.__loadBodies(documents)
+        
+    @instrumented
+    def saveCheckpoint(self, name, checkpoint):
+        """
+        Store the getChanges checkpoint of the consumer with name
+        """
+        self.checkpointCollection.update({"_id": name}, {"$set": {"checkpoint": checkpoint, "updated": datetime.utcnow()}}, upsert=True)
+        
+    @instrumented
+    def getCheckpoint(self, name):
+        """
+        @return the getChanges checkpoint stored for the consumer with name, None when there is none
+        """
+        document = self.checkpointCollection.find_one({"_id": name})
+        if document is None:
+            return None
+        return document["checkpoint"]
+        
+    def export(self, path, search=None, batchSize=1000, compresslevel=6):
+        """
+        Write the versions matching search to path as gzip compressed JSON Lines, 1 version per line in _id order
+        The collection is streamed so only batchSize versions are in memory, ids and dates are written as strings
+        @param search the query for the versions to export, None for all versions
+        @return the number of exported versions
+        """
+        count = 0
+        results = self.collection.find(search or dict()).sort('_id', pymongo.ASCENDING).batch_size(batchSize)
+        with gzip.open(path, "wt", compresslevel=compresslevel, encoding="utf-8") as out:
+            batch = list()
+            for result in results:
+                batch.append(result)
+                if len(batch) >= batchSize:
+                    count += self.__exportBatch(out, batch)
+                    batch = list()
+            count += self.__exportBatch(out, batch)
+        return count
+        
+    def __exportBatch(self, out, batch):
+        """
+        Write batch as JSON Lines to out
+        @return the number of written versions
+        """
+        for record in self.__loadBodies(batch):
+            out.write(json.dumps(record, default=str, sort_keys=True))
+            out.write("\n")
+        return len(batch)
         
+    @instrumented
+    def getBySearch(self, username, search=None, language=None, batchSize=100):
+        """
+        Search as username for the searchstring and return only in language
+        @param batchSize the number of documents fetched per round trip, the bodies saved with dedupe or in GridFS are
+            loaded per batch
+        @return generator with the documents
+        """
         #Making sure the result contains only security groups where user has read access too
         roles = self.getRoles(username, 'r')
         if len(roles) == 0:
             roles.append('public')
+        cur = self.collection.find(self.__searchFilter(roles, search, language))
+        return self.__iterLoaded(cur, batchSize)
+        
+    @instrumented
+    def getSearchPage(self, username, search=None, language=None, after=None, limit=50, fields=None):
+        """
+        Get 1 page of the results of getBySearch, pages are sorted on _id so they stay stable while documents are added
+        @param after the next value returned for the previous page, None for the first page
+        @param limit the number of documents on a page
+        @param fields the fields to return e.g. ["metadata"], None for the complete documents
+        @return (documents, next) where next is the after value for the next page or None after the last page
+        """
+        roles = self.getRoles(username, 'r')
+        if len(roles) == 0:
+            roles.append('public')
+        cur = self.collection.find(self.__searchFilter(roles, search, language, after), self.__projection(fields))
+        documents = self.__loadBodies(list(cur.sort('_id', pymongo.ASCENDING).limit(limit)))
+        next = None
+        if len(documents) == limit:
+            next = documents[-1]["_id"]
+        return documents, next
+        
+    def iterBySearch(self, username, search=None, language=None, fields=None, batchSize=100):
+        """
+        Stream the results of getBySearch page by page, memory use is bound by batchSize
+        @return generator with the documents sorted on _id
+        """
+        after = None
+        while True:
+            documents, after = self.getSearchPage(username, search, language, after, batchSize, fields)
+            for document in documents:
+                yield document
+            if after is None:
+                break
+        
+    def __searchFilter(self, roles, search, language, after=None):
+        """
+        @return the query for active documents in roles, in language and matching search
+        @param after only documents with an _id after this one
+        """
+        #We are only interested in active data
+        searchString = [{"metadata.active":True}]
+        
         roleSearch = {"metadata.groups": {'$in': roles}}
         searchString.append(roleSearch)
         
@@ -134,75 +666,557 @@ class DocumentStore:
         #Adding the userspecified search
         if search != None:
             searchString.append(search)
+        #The page boundary
+        if after != None:
+            searchString.append({"_id": {"$gt": after}})
         
         #All searches added hear should validate to true so we need "and"
-        searchString = {"$and":searchString}
-        cur = self.collection.find(searchString)
-        return cur
+        return {"$and":searchString}
+        
+    @instrumented
+    def searchText(self, username, text, language=None, limit=20, fields=None):
+        """
+        Search the text of the active documents username can read, needs fullText
+        @param text the words to search for
+        @param language only documents in language, None for all languages
+        @param fields the fields to return e.g. ["metadata"], None for the complete documents
+        @return the best limit documents with their relevance in score, the most relevant first
+        """
+        roles = self.getRoles(username, 'r')
+        if len(roles) == 0:
+            roles.append('public')
+        projection = self.__projection(fields) or dict(text=False)
+        projection["score"] = {"$meta": "textScore"}
+        cur = self.collection.find(self.__searchFilter(roles, {"$text": {"$search": text}}, language), projection)
+        documents = list(cur.sort([("score", {"$meta": "textScore"})]).limit(limit))
+        return self.__loadBodies(documents)
         
+    def __text(self, body):
+        """
+        @return all strings in body joined together, the text searchText searches in
+        """
+        if isinstance(body, dict):
+            return " ".join(self.__text(value) for value in body.values())
+        if isinstance(body, list):
+            return " ".join(self.__text(value) for value in body)
+        if isinstance(body, str):
+            return body
+        return ""
+        
+    @instrumented
     def getRoles(self, username, permission):
-		"""
-		@return the roles where username has permission
-		"""
-        user = self.getUser(username)
-        curGroups = list()
-        for group in user.groups:
-            if permission in group["permissions"]:
-                curGroups.append(group["groupname"])
+        """
+        @return the roles where username has permission
+        """
+        roles = self.roleCache.get(username)
+        if roles is None:
+            roles = dict()
+            self.roleCache.put(username, roles)
+        if permission not in roles:
+            user = self.getUser(username)
+            curGroups = list()
+            for group in user.groups:
+                if permission in group["permissions"]:
+                    curGroups.append(group["groupname"])
+            roles[permission] = curGroups
+        
+        #A copy as callers are allowed to change the list
+        return list(roles[permission])
+        
+    @property
+    def cacheStats(self):
+        """
+        @return the hit and miss counters of the user and role caches
+        """
+        return dict(users=self.userCache.stats, roles=self.roleCache.stats)
         
-        return curGroups
+    def invalidateUser(self, username):
+        """
+        Remove username from the user and role caches
+        """
+        self.userCache.invalidate(username)
+        self.roleCache.invalidate(username)
     
+    @instrumented
     def save(self, document):
         """
         Saves the document Document"
         if you are saving a document with a uri that already exists in the selected lagnuage it will create a new version of that document
+        The version number is taken from a counter per uri and language so concurrent writers never share a version,
+        a save costs 3 round trips no matter how many versions exist, also when a newer version was saved at the same time
         """
         uri = document.metadata["uri"]
+        language = document.metadata["language"]
         
-        #Getting the latest version for this document
-        version = 0
-        self.__previousVersion = self.getLastByURI(uri, document.metadata["language"])
-        if self.__previousVersion != None:
-            version = int(self.__previousVersion["metadata"]["version"])+1
-        
-        #Update the current active version to be inactive as our new version should be the active one
-        docs = self.getAllByURI(uri, document.metadata["language"])
-        for doc in docs:
-            self.collection.update({"metadata.uri":uri, "metadata.active":True},{'$set': {"metadata.active":False}})
+        #Reserving the version for this document
+        version = self.__nextVersion(uri, language)
         
         metadata = document.metadata
-        metadata.update({"version":version})
-        id = self.collection.insert({"document":document.document, "metadata":metadata})
+        metadata.update({"version":version, "active":True})
+        record = self.__record(document)
+        id = record["_id"] = ObjectId()
+        
+        #Inserted active unless a newer version is active already, a concurrent save of that version
+        #could have run its deactivation before our insert so it wouldn't make ours inactive
+        newer = self.__uriQuery(uri, language, True)
+        newer["metadata.version"] = {"$gt": version}
+        result = self.collection.update(newer, {"$setOnInsert": record}, upsert=True)
+        if result.get("updatedExisting"):
+            metadata["active"] = False
+            self.collection.insert(record)
+        else:
+            #Older versions that are still active become inactive as our new version should be the active one
+            self.__deactivate(uri, language, version)
+        
+        if self.documentCache is not None:
+            if "body" in record:
+                self.documentCache.invalidate((uri, language))
+            elif metadata["active"]:
+                #A concurrent save of a newer version could have finished first, then that one stays cached
+                record["document"] = document.document
+                self.__cacheDocument(record)
         return id
         
+    def saveMany(self, documents, chunkSize=1000, ordered=True, report=None):
+        """
+        Save a lot of documents with bulk writes, versioning works as in save
+        With dedupe the bodies are stored complete, deltaThreshold is only used by save
+        This is a generator, nothing is written until the results are consumed
+        @param documents iterable of Document, generators are read chunk by chunk
+        @param chunkSize the number of documents written per bulk operation
+        @param ordered use an ordered bulk operation (stops at the first error) or an unordered one
+        @param report optional function called after each chunk with (saved, seconds, documentsPerSecond)
+        @return generator with a dict(id, uri, language, version) per saved document in input order
+        """
+        start = time.time()
+        saved = 0
+        chunk = list()
+        for document in documents:
+            chunk.append(document)
+            if len(chunk) >= chunkSize:
+                for result in self.__saveChunk(chunk, ordered):
+                    yield result
+                saved += len(chunk)
+                chunk = list()
+                self.__report(report, saved, start)
+        if len(chunk) > 0:
+            for result in self.__saveChunk(chunk, ordered):
+                yield result
+            saved += len(chunk)
+            self.__report(report, saved, start)
+        
+    def __report(self, report, saved, start):
+        """
+        Call report with the throughput of saveMany
+        """
+        if report is not None:
+            seconds = time.time() - start
+            rate = saved / seconds if seconds > 0 else float(saved)
+            report(saved, seconds, rate)
+        
+    @instrumentedAs("saveMany")
+    def __saveChunk(self, chunk, ordered):
+        """
+        Write 1 chunk of saveMany: 1 counter update per uri and language and 1 bulk write
+        @return list with the results for the chunk
+        """
+        #Reserving all versions we need per uri and language at once
+        counts = dict()
+        for document in chunk:
+            key = (document.metadata["uri"], document.metadata["language"])
+            counts[key] = counts.get(key, 0) + 1
+        nextVersions = dict()
+        latest = dict()
+        for key, count in counts.items():
+            nextVersions[key] = self.__nextVersion(key[0], key[1], count)
+            latest[key] = nextVersions[key] + count - 1
+        
+        #With dedupe the bodies are written in 1 bulk upsert before the versions pointing to them
+        blobs = None
+        if self.dedupe:
+            blobs = self.blobCollection.initialize_unordered_bulk_op()
+        if ordered:
+            bulk = self.collection.initialize_ordered_bulk_op()
+        else:
+            bulk = self.collection.initialize_unordered_bulk_op()
+        results = list()
+        queued = False
+        for document in chunk:
+            key = (document.metadata["uri"], document.metadata["language"])
+            version = nextVersions[key]
+            nextVersions[key] += 1
+            metadata = document.metadata
+            #Only the newest version in this chunk stays active
+            metadata.update({"version":version, "active":version == latest[key]})
+            id = ObjectId()
+            record = self.__record(document, blobs)
+            if not metadata["active"]:
+                record.pop("text", None)
+            queued = queued or "blob" in record
+            record["_id"] = id
+            bulk.insert(record)
+            results.append(dict(id=id, uri=key[0], language=key[1], version=version))
+        for key, version in latest.items():
+            bulk.find(self.__deactivateQuery(key[0], key[1], version)).update(self.__deactivation())
+        #Large bodies are in GridFS, a chunk of only large bodies has no blobs and an empty bulk can't be executed
+        if queued:
+            blobs.execute()
+        bulk.execute()
+        self.__deactivateSuperseded(latest)
+        for uri, language in latest:
+            self.invalidateDocument(uri, language)
+        return results
+        
+    def __record(self, document, blobs=None):
+        """
+        @return the record to insert for document, with dedupe the body is stored first and the record points to it
+        @param blobs a bulk operation to add the body to instead of writing it directly
+        """
+        record = {"metadata":document.metadata}
+        if self.fullText:
+            record["text"] = self.__text(document.document)
+        if self.largeThreshold is not None:
+            data, format = self.__encodeBody(document.document)
+            if len(data) > self.largeThreshold:
+                metadata = document.metadata
+                record["body"] = self.bodies.put(data, format=format, uri=metadata["uri"], language=metadata["language"])
+                #Only the start of the text of a large body is searched, the version has to stay far below 16MB
+                if self.fullText:
+                    record["text"] = record["text"][:self.largeThreshold]
+                return record
+        if not self.dedupe:
+            record["document"] = document.document
+            return record
+        body = document.document
+        encoded = json.dumps(body, sort_keys=True, default=str)
+        blobId = hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+        if blobs is not None:
+            blobs.find({"_id": blobId}).upsert().update_one({"$setOnInsert": {"document": body}})
+        else:
+            blob = {"document": body}
+            if self.deltaThreshold is not None and len(encoded) > self.deltaThreshold:
+                blob = self.__delta(document.metadata["uri"], document.metadata["language"], body, blob)
+            self.blobCollection.update({"_id": blobId}, {"$setOnInsert": blob}, upsert=True)
+        record["blob"] = blobId
+        return record
+        
+    def __encodeBody(self, body):
+        """
+        @return (data, format) with body as bytes, strings and bytes are kept as they are so they can be streamed as they are
+        """
+        if isinstance(body, bytes):
+            return body, "bytes"
+        if isinstance(body, str):
+            return body.encode("utf-8"), "text"
+        return json.dumps(body, default=str).encode("utf-8"), "json"
+        
+    def __decodeBody(self, data, format):
+        """
+        @return the body encoded by __encodeBody
+        """
+        if format == "bytes":
+            return data
+        if format == "text":
+            return data.decode("utf-8")
+        return json.loads(data.decode("utf-8"))
+        
+    @instrumented
+    def openBody(self, uri, language, version=None):
+        """
+        Open the body of a version for reading in parts, large bodies are read from GridFS chunk by chunk
+        so the memory used doesn't depend on the size of the body
+        @param version None for the active version
+        @return a binary file-like object with read(size) (utf-8 for text, JSON for other bodies), None when there is no such version
+        """
+        query = self.__uriQuery(uri, language, True if version is None else None)
+        if version is not None:
+            query["metadata.version"] = version
+        record = self.collection.find_one(query, self.__projection(["document"]), sort=[('metadata.version', pymongo.DESCENDING)])
+        if record is None:
+            return None
+        if "body" in record:
+            return self.bodies.get(record["body"])
+        data, format = self.__encodeBody(self.__loadBodies([record])[0].get("document"))
+        return io.BytesIO(data)
+        
+    def __delta(self, uri, language, body, blob):
+        """
+        @return the blob for body as the changes against the complete body the previous version is based on,
+        or blob if there is no previous version or the delta isn't smaller
+        """
+        previous = self.collection.find_one(dict(self.__uriQuery(uri, language), blob={"$exists": True}), {"blob": True}, sort=[('metadata.version', pymongo.DESCENDING)])
+        if previous is None or not isinstance(body, dict):
+            return blob
+        base = self.blobCollection.find_one({"_id": previous["blob"]})
+        #Deltas are always made against a complete body so reading never needs more than 2 blobs
+        if base is not None and "base" in base:
+            base = self.blobCollection.find_one({"_id": base["base"]})
+        if base is None or not isinstance(base.get("document"), dict):
+            return blob
+        changes = dict((key, value) for key, value in body.items() if key not in base["document"] or base["document"][key] != value)
+        removed = [key for key in base["document"] if key not in body]
+        delta = {"base": base["_id"], "set": changes, "unset": removed}
+        if len(json.dumps(delta, default=str)) >= len(json.dumps(blob, default=str)):
+            return blob
+        return delta
+        
+    def __loadBodies(self, records):
+        """
+        Put the bodies back in records saved with dedupe, at most 2 queries for any number of records,
+        large bodies are read from GridFS
+        @return records
+        """
+        for record in records:
+            if "body" in record and "document" not in record:
+                body = self.bodies.get(record["body"])
+                record["document"] = self.__decodeBody(body.read(), getattr(body, "format", "json"))
+        blobIds = set(record["blob"] for record in records if "blob" in record and "document" not in record)
+        if len(blobIds) == 0:
+            return records
+        blobs = dict((blob["_id"], blob) for blob in self.blobCollection.find({"_id": {"$in": list(blobIds)}}))
+        baseIds = set(blob["base"] for blob in blobs.values() if "base" in blob and blob["base"] not in blobs)
+        if len(baseIds) > 0:
+            for blob in self.blobCollection.find({"_id": {"$in": list(baseIds)}}):
+                blobs[blob["_id"]] = blob
+        for record in records:
+            if record.get("blob") in blobs:
+                blob = blobs[record["blob"]]
+                if "base" in blob:
+                    body = dict(blobs[blob["base"]]["document"])
+                    body.update(blob["set"])
+                    for key in blob["unset"]:
+                        body.pop(key, None)
+                else:
+                    body = blob["document"]
+                record["document"] = body
+        return records
+        
+    @instrumented
+    def initCounters(self):
+        """
+        Create the version counters for documents that were saved before the counters existed
+        Saves create a missing counter after the existing versions themselves, running this once on an existing database
+        before concurrent writers start avoids that they reserve versions from a counter that is being created
+        The counters are never lowered
+        """
+        pipeline = [{"$group": {"_id": {"uri": "$metadata.uri", "language": "$metadata.language"}, "version": {"$max": "$metadata.version"}}}]
+        result = self.collection.aggregate(pipeline)
+        if isinstance(result, dict):
+            result = result["result"]
+        for item in result:
+            counterId = self.__counterId(item["_id"]["uri"], item["_id"].get("language"))
+            self.counterCollection.update({"_id": counterId}, {"$max": {"next": int(item["version"])+1}}, upsert=True)
+        
+    @instrumented
+    def countVersions(self, uris):
+        """
+        Count the versions of a lot of uris with 1 query, versions in the archive are not counted
+        @return dict with the number of versions per (uri, language), uris without versions are left out
+        """
+        pipeline = [{"$match": {"metadata.uri": {"$in": list(uris)}}},
+                    {"$group": {"_id": {"uri": "$metadata.uri", "language": "$metadata.language"}, "count": {"$sum": 1}}}]
+        result = self.collection.aggregate(pipeline)
+        if isinstance(result, dict):
+            result = result["result"]
+        return dict(((item["_id"]["uri"], item["_id"].get("language")), item["count"]) for item in result)
+        
+    def compact(self, batchSize=1000, after=None, pause=0):
+        """
+        Move the inactive versions keepVersions and maxAge don't keep to the archive, so the collection and its indexes
+        only grow with the live content. Batches are read in _id order and every batch can be repeated,
+        so an interrupted compaction resumes from the last after it yielded
+        This is a generator, nothing is moved until the results are consumed
+        @param batchSize the number of inactive versions checked per batch, a batch costs at most 4 round trips
+        @param after the after of the last batch of an earlier compaction, None to start at the beginning
+        @param pause the number of seconds to wait between batches to limit the load of a background compaction
+        @return generator with a dict(checked, archived, after) per batch
+        """
+        while True:
+            result = self.__compactBatch(batchSize, after)
+            if result["checked"] == 0:
+                break
+            after = result["after"]
+            yield result
+            if result["checked"] < batchSize:
+                break
+            if pause > 0:
+                time.sleep(pause)
+        
+    def __compactQuery(self, after):
+        """
+        @return the query for the inactive versions after the _id after
+        """
+        query = {"metadata.active": False}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        return query
+        
+    @instrumentedAs("compact")
+    def __compactBatch(self, batchSize, after):
+        """
+        Check the next batchSize inactive versions after the _id after and archive the expired ones
+        @return dict(checked, archived, after) for the batch
+        """
+        projection = {"metadata.uri": True, "metadata.language": True, "metadata.version": True, "metadata.createdate": True}
+        records = list(self.collection.find(self.__compactQuery(after), projection).sort('_id', pymongo.ASCENDING).limit(batchSize))
+        if len(records) == 0:
+            return dict(checked=0, archived=0, after=after)
+        archived = self.__archive(self.__expired(records))
+        return dict(checked=len(records), archived=archived, after=records[-1]["_id"])
+        
+    def __expired(self, records):
+        """
+        @return the ids of the records keepVersions and maxAge don't keep
+        """
+        if self.keepVersions is None and self.maxAge is None:
+            return list()
+        #The newest version is the one before the next version of the counter
+        counters = dict()
+        if self.keepVersions is not None:
+            counterIds = list(set(self.__counterId(record["metadata"]["uri"], record["metadata"]["language"]) for record in records))
+            for counter in self.counterCollection.find({"_id": {"$in": counterIds}}):
+                counters[counter["_id"]] = int(counter["next"])
+        cutoff = None
+        if self.maxAge is not None:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.maxAge)
+        expired = list()
+        for record in records:
+            metadata = record["metadata"]
+            if self.keepVersions is not None:
+                next = counters.get(self.__counterId(metadata["uri"], metadata["language"]))
+                if next is None or metadata["version"] >= next - self.keepVersions:
+                    continue
+            if cutoff is not None and metadata["createdate"] >= cutoff:
+                continue
+            expired.append(record["_id"])
+        return expired
+        
+    def __archive(self, ids):
+        """
+        Copy the records with ids to the archive and remove them from the collection
+        The copy is an upsert on _id so repeating an interrupted batch doesn't duplicate records
+        @return the number of archived records
+        """
+        if len(ids) == 0:
+            return 0
+        records = list(self.collection.find({"_id": {"$in": ids}}))
+        bulk = self.archiveCollection.initialize_unordered_bulk_op()
+        for record in records:
+            #Only active versions are searched so the archive doesn't need the text
+            record.pop("text", None)
+            id = record.pop("_id")
+            bulk.find({"_id": id}).upsert().update_one({"$setOnInsert": record})
+        bulk.execute()
+        self.collection.remove({"_id": {"$in": ids}})
+        return len(records)
+        
+    def __counterId(self, uri, language):
+        """
+        @return the id of the version counter for uri in language
+        """
+        return "%s:%s" % (language, uri)
+        
+    def __nextVersion(self, uri, language, count=1):
+        """
+        Atomically reserve count versions for uri in language
+        A counter that doesn't exist yet is created after the versions saved before the counters existed,
+        this costs 1 or 2 more round trips once per uri and language (initCounters does it ahead for all documents)
+        @return the first reserved version
+        """
+        counterId = self.__counterId(uri, language)
+        counter = self.counterCollection.find_and_modify({"_id": counterId}, {"$inc": {"next": count}}, upsert=True, new=True)
+        if int(counter["next"]) == count:
+            #The counter was just created
+            last = self.collection.find_one(self.__uriQuery(uri, language), {"metadata.version": True}, sort=[('metadata.version', pymongo.DESCENDING)])
+            if last is not None:
+                first = int(last["metadata"]["version"]) + 1
+                #Our reservation moves past the existing versions when nobody reserved versions after it in the meantime
+                if self.counterCollection.find_and_modify({"_id": counterId, "next": count}, {"$set": {"next": first + count}}) is not None:
+                    return first
+                self.counterCollection.update({"_id": counterId}, {"$max": {"next": first}})
+                return self.__nextVersion(uri, language, count)
+        return int(counter["next"]) - count
+        
+    def __deactivate(self, uri, language, version):
+        """
+        Make all active versions older than version inactive in 1 update
+        """
+        self.collection.update(self.__deactivateQuery(uri, language, version), self.__deactivation(), multi=True)
+        
+    def __deactivateSuperseded(self, versions):
+        """
+        Make the just saved versions inactive when a newer version is active, 1 query and 1 update for any number of versions
+        A concurrent save of a newer version can run its deactivation before our version is inserted,
+        that save can't deactivate our version so we have to do it ourselves
+        @param versions dict with the saved version per (uri, language)
+        @return the set of (uri, language) of which the saved version was made inactive
+        """
+        newer = list()
+        for (uri, language), version in versions.items():
+            query = self.__uriQuery(uri, language, True)
+            query["metadata.version"] = {"$gt": version}
+            newer.append(query)
+        projection = {"metadata.uri": True, "metadata.language": True}
+        superseded = set((record["metadata"]["uri"], record["metadata"]["language"]) for record in self.collection.find({"$or": newer}, projection))
+        if len(superseded) > 0:
+            own = list()
+            for uri, language in superseded:
+                query = self.__uriQuery(uri, language, True)
+                query["metadata.version"] = versions[(uri, language)]
+                own.append(query)
+            self.collection.update({"$or": own}, self.__deactivation(), multi=True)
+        return superseded
+        
+    def __deactivation(self):
+        """
+        @return the update making versions inactive, the time of the deactivation is kept for getChanges
+        and the text is removed as searchText only searches active versions
+        """
+        return {'$set': {"metadata.active":False, "metadata.deactivated":datetime.utcnow()}, '$unset': {"text": ""}}
+        
+    def __deactivateQuery(self, uri, language, version):
+        """
+        @return the query for the active versions of uri in language older than version
+        """
+        query = self.__uriQuery(uri, language, True)
+        query["metadata.version"] = {"$lt": version}
+        return query
+        
+    @instrumented
     def createUser(self, user):
-		"""
-		Create a new user
-		"""
+        """
+        Create a new user
+        """
         existingUser = self.getUser(user.username)
         id = None
         if existingUser == None:
             id = self.ctxCollection.insert(user.document)
+            self.invalidateUser(user.username)
         else:
             id = self.updateUser(user)
         return id
     
+    @instrumented
     def getUser(self, username):
-		"""
-		Get document of user with username
-		"""
-        user = None
-        document = self.ctxCollection.find_one({"username":username})
-        if document != None:
-            user = User(document)
+        """
+        Get document of user with username
+        """
+        user = self.userCache.get(username)
+        if user is None:
+            document = self.ctxCollection.find_one({"username":username})
+            if document != None:
+                user = User(document)
+                self.userCache.put(username, user)
         return user
     
+    @instrumented
     def updateUser(self, user):
-		"""
-		update user with data found in the user obj
-		"""
+        """
+        update user with data found in the user obj
+        """
         id = None
         self.ctxCollection.update({"username":user.username}, {"$set": {"groups":user.groups}})
+        self.invalidateUser(user.username)
         
  
 ### TEST CODE ### 
@@ -228,7 +1242,8 @@ class DocumentStore:
 #ds.getBySearch({"document.attributes": {'$elemMatch' : {'tag':"red", 'tag':"round"}}})
 
 ## INDEXES ##
-#ds.collection.ensure_index([("metadata.uri",pymongo.ASCENDING), ("metadata.active", pymongo.ASCENDING)])
+#ds.ensureIndexes()
+#pprint([(plan["name"], plan["collectionScan"]) for plan in ds.checkQueryPlans()])
 
 ## USERS ##
 #ds.db.create_collection("cms.context")
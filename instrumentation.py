@@ -0,0 +1,287 @@
+import functools
+import threading
+import time
+
+#Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        @param buckets the upper bounds of the buckets in seconds, slower observations go in an extra overflow bucket
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """
+        Add 1 observation
+        """
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """
+        @return the upper bound of the bucket containing the given fraction (0.5, 0.99, ...) of the observations
+        """
+        if self.count == 0:
+            return 0.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    @property
+    def document(self):
+        """
+        @return the histogram as a dict
+        """
+        mean = self.total / self.count if self.count > 0 else 0.0
+        return dict(count=self.count, mean=mean, max=self.max, p50=self.percentile(0.5), p99=self.percentile(0.99),
+                    buckets=list(zip(list(self.buckets) + [None], self.counts)))
+
+class Instrumentation:
+    """
+    Counts the calls of the store methods and the round trips to the backends they cause, with their latency
+    A store without instrumentation only pays for a None check per call
+    Hooks are called for every event with (kind, name, backend, seconds) where kind is "call" or "roundTrip",
+    to export the measurements to another system
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """
+        @param buckets the upper bounds of the latency histogram buckets in seconds
+        """
+        self.__buckets = buckets
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__hooks = list()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all measurements
+        """
+        with self.__lock:
+            self.calls = dict()
+            self.roundTrips = dict()
+            self.methodRoundTrips = dict()
+            self.latency = dict()
+
+    def addHook(self, hook):
+        """
+        Call hook(kind, name, backend, seconds) for every call and round trip
+        """
+        self.__hooks.append(hook)
+
+    def removeHook(self, hook):
+        """
+        Stop calling hook
+        """
+        self.__hooks.remove(hook)
+
+    def call(self, name, method, *args, **kwargs):
+        """
+        Call method as the store method with name, round trips made during the call are counted for name
+        Only the outermost store method is counted when store methods call each other
+        @return the result of method
+        """
+        stack = getattr(self.__local, "stack", None)
+        if stack is None:
+            stack = self.__local.stack = list()
+        stack.append(name)
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            seconds = time.time() - start
+            stack.pop()
+            if len(stack) == 0:
+                self.__record("call", name, None, seconds)
+
+    def roundTrip(self, backend, operation, method, *args, **kwargs):
+        """
+        Call method as 1 round trip to backend
+        @return the result of method
+        """
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.addRoundTrip(backend, operation, time.time() - start)
+
+    def addRoundTrip(self, backend, operation, seconds):
+        """
+        Count 1 round trip to backend that took seconds, for round trips that aren't 1 method call like the batches of a cursor
+        """
+        self.__record("roundTrip", operation, backend, seconds)
+
+    def __record(self, kind, name, backend, seconds):
+        """
+        Add 1 measurement and call the hooks
+        """
+        with self.__lock:
+            if kind == "call":
+                self.calls[name] = self.calls.get(name, 0) + 1
+                key = name
+            else:
+                key = (backend, name)
+                self.roundTrips[key] = self.roundTrips.get(key, 0) + 1
+                stack = getattr(self.__local, "stack", None)
+                if stack:
+                    methodKey = (stack[0], backend)
+                    self.methodRoundTrips[methodKey] = self.methodRoundTrips.get(methodKey, 0) + 1
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram(self.__buckets)
+            histogram.observe(seconds)
+        for hook in self.__hooks:
+            hook(kind, name, backend, seconds)
+
+    def roundTripsPerCall(self, name):
+        """
+        @return dict with the average number of round trips per backend for 1 call of the store method with name
+        """
+        calls = self.calls.get(name, 0)
+        if calls == 0:
+            return dict()
+        return dict((backend, float(count) / calls) for (method, backend), count in self.methodRoundTrips.items() if method == name)
+
+    @property
+    def document(self):
+        """
+        @return all measurements as a dict
+        """
+        with self.__lock:
+            return dict(calls=dict(self.calls),
+                        roundTrips=dict(("%s.%s" % key, count) for key, count in self.roundTrips.items()),
+                        methodRoundTrips=dict(("%s.%s" % key, count) for key, count in self.methodRoundTrips.items()),
+                        latency=dict((key if type(key) == str else "%s.%s" % key, histogram.document) for key, histogram in self.latency.items()))
+
+def instrumented(method):
+    """
+    Decorator for store methods, counts the calls when the instrumentation attribute of the object isn't None
+    """
+    return instrumentedAs(method.__name__)(method)
+
+def instrumentedAs(name):
+    """
+    Decorator for store methods like instrumented, the calls are counted under name
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            instrumentation = self.instrumentation
+            if instrumentation is None:
+                return method(self, *args, **kwargs)
+            return instrumentation.call(name, method, self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class InstrumentedProxy:
+    """
+    Wraps an object (a pymongo collection, a bulk operation, ...) and counts calls to the given operations as round trips
+    """
+
+    def __init__(self, target, instrumentation, backend, operations, wrappers=None):
+        """
+        @param target the wrapped object
+        @param operations the names of the methods that do a round trip
+        @param wrappers dict with a function per method name that wraps the result of that method (e.g. a bulk operation),
+            also for operations
+        """
+        self.target = target
+        self.__instrumentation = instrumentation
+        self.__backend = backend
+        self.__operations = operations
+        self.__wrappers = wrappers or dict()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if name in self.__operations:
+            instrumentation = self.__instrumentation
+            backend = self.__backend
+            wrapper = self.__wrappers.get(name)
+            def operation(*args, **kwargs):
+                result = instrumentation.roundTrip(backend, name, attribute, *args, **kwargs)
+                return result if wrapper is None else wrapper(result)
+            return operation
+        if name in self.__wrappers:
+            wrapper = self.__wrappers[name]
+            def wrapped(*args, **kwargs):
+                return wrapper(attribute(*args, **kwargs))
+            return wrapped
+        return attribute
+
+class InstrumentedCursor:
+    """
+    Wraps a cursor (of a pymongo find), the round trips happen when it's read: the first batch and every further batch (getMore)
+    are counted as round trips with the time of the read that fetched them
+    Batches are recognized by the retrieved attribute of the cursor, without it only the first batch is counted
+    """
+
+    #The cursor methods that do a round trip of their own
+    OPERATIONS = ["count", "distinct", "explain"]
+
+    def __init__(self, target, instrumentation, backend, operation):
+        """
+        @param target the wrapped cursor
+        @param operation the name under which the batches are counted e.g. "find"
+        """
+        self.target = target
+        self.__instrumentation = instrumentation
+        self.__backend = backend
+        self.__operation = operation
+        self.__started = False
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if not callable(attribute):
+            return attribute
+        if name in self.OPERATIONS:
+            instrumentation = self.__instrumentation
+            backend = self.__backend
+            def operation(*args, **kwargs):
+                return instrumentation.roundTrip(backend, name, attribute, *args, **kwargs)
+            return operation
+        target = self.target
+        #sort, limit, batch_size, ... return the cursor itself so they can be chained
+        def chained(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            return self if result is target else result
+        return chained
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self.target[index]
+            return self
+        return self.__instrumentation.roundTrip(self.__backend, self.__operation, self.target.__getitem__, index)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        retrieved = getattr(self.target, "retrieved", None)
+        start = time.time()
+        try:
+            return next(self.target)
+        finally:
+            if not self.__started or getattr(self.target, "retrieved", None) != retrieved:
+                self.__started = True
+                self.__instrumentation.addRoundTrip(self.__backend, self.__operation, time.time() - start)
+
+    next = __next__
@@ -0,0 +1,172 @@
+"""
+Migration of the documents of the Neo4j store (GraphDB_CMS) to the MongoDB store (documentStore)
+Run: python migrate.py http://localhost:7474/db/data/ localhost 27017 --checkpoint migrate.json
+"""
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import time
+import documentStore
+import GraphDB_CMS
+
+def userGroup(username):
+    """
+    @return the MongoDB group of the documents username has access to in Neo4j
+    """
+    return "user:" + username
+
+class Migration:
+    """
+    Copies all documents from a Neo4j store to a MongoDB store page by page
+    A page of documents is read with 4 queries and written with 1 bulk write, the pages are migrated by a pool of threads
+    Every version of every translation becomes a version in MongoDB with body dict(content, attributes),
+    the attributes are those of the document with those of the translation, keys in lower case like Document.attributes
+    Access works through groups: a user with access to a document in Neo4j gets the group userGroup(username)
+    Documents without content have no versions and are not migrated
+    """
+
+    def __init__(self, graphStore, mongoStore, pageSize=100, workers=8, checkpoint=None, creator="migration", report=None):
+        """
+        @param graphStore the GraphDB_CMS.DocumentStore to read
+        @param mongoStore the documentStore.DocumentStore to write
+        @param pageSize the number of documents read and written together
+        @param workers the number of threads migrating pages, the requests are I/O bound so threads are enough
+        @param checkpoint the path of the file in which the progress is kept, None to always start at the beginning
+        @param creator the creator of the migrated versions
+        @param report optional function called after each page with (documents, seconds, documentsPerSecond)
+        """
+        self.graphStore = graphStore
+        self.mongoStore = mongoStore
+        self.pageSize = pageSize
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.creator = creator
+        self.report = report
+        self.__users = set()
+
+    def run(self):
+        """
+        Migrate all documents after the checkpoint
+        The checkpoint only moves past a page when it and all pages before it are written,
+        a page that is migrated again after an interruption only writes the versions that are missing
+        @return dict(documents, versions, seconds) for this run
+        """
+        progress = self.__loadCheckpoint()
+        after = progress["after"]
+        documents = 0
+        versions = 0
+        start = time.time()
+        #Pages in the order they were read, the oldest is finished first so the checkpoint never skips a page
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            done = False
+            while not done:
+                names, after = self.graphStore.getDocumentNames(after, self.pageSize)
+                done = after is None
+                if len(names) > 0:
+                    pending.append((names, executor.submit(self.migratePage, names)))
+                while len(pending) > 0 and (done or len(pending) >= 2 * self.workers):
+                    names, future = pending.popleft()
+                    users, count = future.result()
+                    self.__ensureUsers(users)
+                    documents += len(names)
+                    versions += count
+                    progress = dict(after=names[-1], documents=progress["documents"] + len(names), versions=progress["versions"] + count)
+                    self.__saveCheckpoint(progress)
+                    self.__report(documents, start)
+        return dict(documents=documents, versions=versions, seconds=time.time() - start)
+
+    def migratePage(self, names):
+        """
+        Migrate the documents with names, versions that are already in MongoDB are skipped
+        @return (users, versions) with the usernames that need a group and the number of written versions
+        """
+        exported = self.graphStore.exportDocuments(names)
+        counts = self.mongoStore.countVersions(names)
+        users = set()
+        records = list()
+        for name in names:
+            document = exported[name]
+            groups = [userGroup(username) for username in document["users"]]
+            users.update(document["users"])
+            for language, contents in document["versions"].items():
+                attributes = dict((key.lower(), values) for key, values in document["attributes"].items())
+                attributes.update((key.lower(), values) for key, values in document["translated"].get(language, dict()).items())
+                language = language.lower()
+                for content in contents[counts.get((name, language), 0):]:
+                    body = dict(content=content, attributes=attributes)
+                    records.append(documentStore.Document(body, name, language, self.creator, groups))
+        if len(records) > 0:
+            for result in self.mongoStore.saveMany(records, chunkSize=len(records)):
+                pass
+        return users, len(records)
+
+    def __ensureUsers(self, usernames):
+        """
+        Create the users or add the group of their documents to them, each user once per migration
+        """
+        for username in usernames:
+            if username in self.__users:
+                continue
+            group = userGroup(username)
+            user = self.mongoStore.getUser(username)
+            if user is None:
+                user = documentStore.User(username)
+                user.addGroup(group, ["r", "w"])
+                self.mongoStore.createUser(user)
+            elif group not in [current["groupname"] for current in user.groups]:
+                #A copy, the user from getUser can be the cached one
+                user = documentStore.User(dict(username=username, groups=[dict(current) for current in user.groups]))
+                user.addGroup(group, ["r", "w"])
+                self.mongoStore.updateUser(user)
+            self.__users.add(username)
+
+    def __loadCheckpoint(self):
+        """
+        @return the progress in the checkpoint file, or that of a new migration
+        """
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as checkpoint:
+                return json.load(checkpoint)
+        return dict(after=None, documents=0, versions=0)
+
+    def __saveCheckpoint(self, progress):
+        """
+        Replace the checkpoint file by progress, the file is never half written
+        """
+        if self.checkpoint is None:
+            return
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, "w") as checkpoint:
+            json.dump(progress, checkpoint)
+        os.replace(temporary, self.checkpoint)
+
+    def __report(self, documents, start):
+        """
+        Call report with the throughput of the migration
+        """
+        if self.report is not None:
+            seconds = time.time() - start
+            rate = documents / seconds if seconds > 0 else float(documents)
+            self.report(documents, seconds, rate)
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the documents of the Neo4j CMS store to the MongoDB CMS store")
+    parser.add_argument("graph", help="the url of the Neo4j REST API e.g. http://localhost:7474/db/data/")
+    parser.add_argument("host", help="the MongoDB host")
+    parser.add_argument("port", type=int, help="the MongoDB port")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--checkpoint", default=None, help="file in which the progress is kept to resume an interrupted migration")
+    parser.add_argument("--creator", default="migration")
+    args = parser.parse_args()
+    report = lambda documents, seconds, rate: print("%d documents in %.1fs, %.1f documents/s" % (documents, seconds, rate))
+    migration = Migration(GraphDB_CMS.DocumentStore(args.graph), documentStore.DocumentStore(args.host, args.port),
+                          args.page_size, args.workers, args.checkpoint, args.creator, report)
+    result = migration.run()
+    print("migrated %d documents, %d versions in %.1fs" % (result["documents"], result["versions"], result["seconds"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+#The modules of the stores are in the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -0,0 +1,109 @@
+"""
+Tests of the Neo4j store against the in-process fakes of benchmark.py
+"""
+import contextlib
+import io
+import pytest
+
+pytest.importorskip("py2neo")
+#benchmark.py fakes both backends
+pytest.importorskip("pymongo")
+pytest.importorskip("bson")
+
+import benchmark
+import GraphDB_CMS
+
+@pytest.fixture
+def manager():
+    manager = benchmark.FakeConnectionManager(benchmark.FakeServer(), benchmark.FakeServer())
+    fake = benchmark.FakeNeo4j(manager.graph("fake"))
+    fake.install()
+    GraphDB_CMS.VALUE_NODES.clear()
+    yield manager
+    fake.uninstall()
+
+def createStore(manager, **options):
+    return GraphDB_CMS.DocumentStore("fake", connectionManager=manager, **options)
+
+def save(store, name, content, language="EN", user="tester"):
+    #New documents print a message
+    with contextlib.redirect_stdout(io.StringIO()):
+        document = store.createDocument(name, language)
+    document.addContent(content)
+    document.saveFile(user)
+
+LONG = "the quick brown fox jumps over the lazy dog " * 4
+
+@pytest.mark.parametrize("chunkSize", [None, 16])
+def test_searchText(manager, chunkSize):
+    store = createStore(manager, fullText=True, chunkSize=chunkSize)
+    save(store, "fox", LONG)
+    save(store, "dog", "a dog")
+    save(store, "cat", "a cat")
+    save(store, "hidden", "fox fox fox", user="other")
+    results = store.searchText("tester", "fox dog")
+    assert [result["documentName"] for result in results] == ["fox", "dog"]
+    assert results[0]["content"] == LONG
+    assert results[0]["language"] == "EN"
+    assert [result["documentName"] for result in store.searchText("tester", "fox dog", limit=1)] == ["fox"]
+    assert store.searchText("tester", "fox", language="NL") == []
+
+def test_searchTextFindsOnlyCurrentContent(manager):
+    store = createStore(manager, fullText=True, chunkSize=16)
+    save(store, "page", LONG)
+    save(store, "page", "replaced")
+    assert store.searchText("tester", "fox") == []
+    assert [result["content"] for result in store.searchText("tester", "replaced")] == ["replaced"]
+
+@pytest.mark.parametrize("chunkSize", [None, 16])
+def test_iterVersions(manager, chunkSize):
+    store = createStore(manager, chunkSize=chunkSize)
+    contents = ["short", LONG, LONG.upper()]
+    for content in contents:
+        save(store, "page", content)
+    versions = list(store.iterVersions("page", "EN", batchSize=2))
+    assert versions == [dict(version=i, content=content) for i, content in enumerate(contents)]
+
+def test_chunkedContent(manager):
+    store = createStore(manager, chunkSize=16)
+    save(store, "page", LONG)
+    assert store.getDocumentContent("page", "EN") == LONG
+    content = store.openContent("page", "EN", chunksPerRequest=2)
+    assert content.read(20) == LONG[:20]
+    assert content.read() == LONG[20:]
+
+def test_firstSaveRemovesDuplicateRelationships(manager):
+    graph = manager.graph("fake")
+    graph.duplicates = 3
+    store = createStore(manager)
+    save(store, "page", "first")
+    assert graph.duplicates == 0
+    assert store.getDocumentContent("page", "EN") == "first"
+    #The check runs once for the database
+    requests = graph.server.requests
+    save(createStore(manager), "page", "second")
+    assert graph.server.requests - requests == 3
+
+def saveAttributes(store, name, attributes, language="EN"):
+    with contextlib.redirect_stdout(io.StringIO()):
+        document = store.createDocument(name, language)
+    for key, value, translatable in attributes:
+        document.addAttribute(key, value, translatable)
+    document.saveFile("tester")
+
+def test_facetSearch(manager):
+    store = createStore(manager)
+    saveAttributes(store, "apple", [("color", "red", None), ("shape", "round", None), ("taste", "zoet", "NL")], "NL")
+    saveAttributes(store, "brick", [("color", "red", None), ("shape", "square", None)])
+    saveAttributes(store, "ball", [("color", "blue", None), ("shape", "round", None)])
+    names, counts = store.facetSearch({"color": "red", "shape": ["round", "oval"]})
+    assert names == ["apple"]
+    assert counts == {"color": {"red": 1}, "shape": {"round": 1}}
+    names, counts = store.facetSearch({"color": "red", "shape": "round"}, facets=["color"], matchAll=False)
+    assert names == ["apple", "ball", "brick"]
+    assert counts == {"color": {"red": 2, "blue": 1}}
+    #The translatable attributes only match in their language
+    assert store.facetSearch({"taste": "zoet"})[0] == []
+    names, counts = store.facetSearch({"taste": "zoet"}, language="nl")
+    assert names == ["apple"]
+    assert counts["taste"] == {"zoet": 1}
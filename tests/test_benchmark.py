@@ -0,0 +1,31 @@
+"""
+Tests of the offline benchmark and its fakes
+"""
+import pytest
+
+pytest.importorskip("pymongo")
+pytest.importorskip("bson")
+pytest.importorskip("py2neo")
+
+import benchmark
+
+def test_corpusIsReproducible():
+    first = benchmark.Corpus(documents=5, seed=3)
+    second = benchmark.Corpus(documents=5, seed=3)
+    assert [first.text() for i in range(5)] == [second.text() for i in range(5)]
+
+@pytest.mark.parametrize("run", [benchmark.benchmarkMongo, benchmark.benchmarkGraph])
+def test_benchmarkMeasuresEveryOperation(run):
+    corpus = benchmark.Corpus(documents=10, versions=2, attributes=2, values=2, users=3)
+    results = run(corpus)
+    assert len(results) == 3
+    for result in results:
+        assert result["calls"] > 0
+        assert result["roundTrips"] >= 1.0
+
+def test_fakeServerCountsRoundTrips():
+    server = benchmark.FakeServer()
+    collection = benchmark.FakeDatabase(server)["cms.nodes"]
+    collection.insert({"n": 1})
+    assert [document["n"] for document in collection.find({"n": 1})] == [1]
+    assert server.requests == 2
@@ -0,0 +1,381 @@
+"""
+Tests of the MongoDB store against the in-process fakes of benchmark.py
+"""
+from datetime import timedelta
+import time
+import pytest
+
+pytest.importorskip("pymongo")
+pytest.importorskip("bson")
+#benchmark.py fakes both backends
+pytest.importorskip("py2neo")
+
+from bson.objectid import ObjectId
+import benchmark
+import documentStore
+from cache import LRUCache
+from instrumentation import Instrumentation
+
+@pytest.fixture
+def manager():
+    return benchmark.FakeConnectionManager(benchmark.FakeServer(), benchmark.FakeServer())
+
+def createStore(manager, **options):
+    return documentStore.DocumentStore("localhost", 27017, connectionManager=manager, **options)
+
+def createDocument(uri, body, language="en"):
+    return documentStore.Document(body, uri, language, "tester", ["public"])
+
+def createReader(store, username="tester", groups=("public",)):
+    user = documentStore.User(username)
+    for group in groups:
+        user.addGroup(group, "r")
+    store.createUser(user)
+
+def versions(store, uri, language="en"):
+    """
+    @return (version, active) of all versions of uri in the collection
+    """
+    return sorted((record["metadata"]["version"], record["metadata"]["active"]) for record in store.collection.documents
+                  if record["metadata"]["uri"] == uri and record["metadata"]["language"] == language)
+
+### VERSIONING ###
+
+def test_saveInterleavedWithNewerSave(manager):
+    first = createStore(manager)
+    second = createStore(manager)
+    first.save(createDocument("page", {"n": 0}))
+    collection = first.collection
+    #The second save reserves and writes its version between the version reservation and the insert of the first
+    def update(*args, **kwargs):
+        del collection.update
+        second.save(createDocument("page", {"n": 2}))
+        return collection.update(*args, **kwargs)
+    collection.update = update
+    first.save(createDocument("page", {"n": 1}))
+    assert versions(first, "page") == [(0, False), (1, False), (2, True)]
+    assert first.getLastByURI("page", "en")["document"] == {"n": 2}
+
+def test_saveManyInterleavedWithNewerSave(manager):
+    first = createStore(manager)
+    second = createStore(manager)
+    collection = first.collection
+    initialize = collection.initialize_ordered_bulk_op
+    def initializeBulk():
+        del collection.initialize_ordered_bulk_op
+        second.save(createDocument("page", {"n": 2}))
+        return initialize()
+    collection.initialize_ordered_bulk_op = initializeBulk
+    list(first.saveMany([createDocument("page", {"n": 0}), createDocument("page", {"n": 1})]))
+    assert versions(first, "page") == [(0, False), (1, False), (2, True)]
+
+def test_saveCosts3RoundTrips():
+    server = benchmark.FakeServer()
+    store = createStore(benchmark.FakeConnectionManager(server, benchmark.FakeServer()))
+    store.save(createDocument("page", {"n": 0}))
+    requests = server.requests
+    store.save(createDocument("page", {"n": 1}))
+    assert server.requests - requests == 3
+
+def insertBaseline(store, uri, count):
+    """
+    Insert count versions of uri like they were saved before the version counters existed
+    """
+    for version in range(count):
+        metadata = createDocument(uri, {}).metadata
+        metadata.update(version=version, active=version == count - 1)
+        store.collection.insert(dict(metadata=metadata, document={"n": version}))
+
+def test_saveAfterUpgradeContinuesTheVersions(manager):
+    store = createStore(manager)
+    insertBaseline(store, "page", 3)
+    store.save(createDocument("page", {"n": "new"}))
+    assert versions(store, "page") == [(0, False), (1, False), (2, False), (3, True)]
+    assert store.getLastByURI("page", "en")["document"] == {"n": "new"}
+    store.save(createDocument("page", {"n": "newer"}))
+    assert versions(store, "page")[-1] == (4, True)
+
+def test_saveManyAfterUpgradeContinuesTheVersions(manager):
+    store = createStore(manager)
+    insertBaseline(store, "page", 2)
+    results = list(store.saveMany([createDocument("page", {"n": "a"}), createDocument("page", {"n": "b"})]))
+    assert [result["version"] for result in results] == [2, 3]
+    assert versions(store, "page") == [(0, False), (1, False), (2, False), (3, True)]
+
+### USERS ###
+
+def test_rolesCachedUntilUserChanges(manager):
+    store = createStore(manager)
+    createReader(store)
+    before = store.cacheStats
+    assert store.getRoles("tester", "r") == ["public"]
+    assert store.getRoles("tester", "r") == ["public"]
+    after = store.cacheStats
+    #The user is read once, the second call finds the roles in the cache
+    assert after["users"]["misses"] - before["users"]["misses"] == 1
+    assert after["roles"]["hits"] - before["roles"]["hits"] == 1
+    user = documentStore.User("tester")
+    user.addGroup("public", "r")
+    user.addGroup("editors", "r")
+    store.updateUser(user)
+    assert store.getRoles("tester", "r") == ["public", "editors"]
+
+### SEARCH ###
+
+def test_searchPages(manager):
+    store = createStore(manager)
+    createReader(store)
+    list(store.saveMany([createDocument("page%d" % i, {"n": i}) for i in range(5)]))
+    documents, after = store.getSearchPage("tester", language="en", limit=2, fields=["metadata"])
+    assert [document["metadata"]["uri"] for document in documents] == ["page0", "page1"]
+    assert "document" not in documents[0]
+    documents, after = store.getSearchPage("tester", language="en", after=after, limit=3)
+    assert [document["document"] for document in documents] == [{"n": 2}, {"n": 3}, {"n": 4}]
+    assert store.getSearchPage("tester", language="en", after=after, limit=3) == ([], None)
+    assert [document["metadata"]["uri"] for document in store.iterBySearch("tester", language="en", batchSize=2)] == ["page%d" % i for i in range(5)]
+
+### BULK SAVES ###
+
+def test_saveManyWritesChunksLazily(manager):
+    store = createStore(manager)
+    reports = list()
+    documents = (createDocument("page%d" % (i % 2), {"n": i}) for i in range(5))
+    results = store.saveMany(documents, chunkSize=2, report=lambda saved, seconds, rate: reports.append(saved))
+    assert store.collection.documents == []
+    results = list(results)
+    assert [(result["uri"], result["version"]) for result in results] == [("page0", 0), ("page1", 0), ("page0", 1), ("page1", 1), ("page0", 2)]
+    assert reports == [2, 4, 5]
+    assert versions(store, "page0") == [(0, False), (1, False), (2, True)]
+    assert versions(store, "page1") == [(0, False), (1, True)]
+    assert store.getLastByURI("page1", "en")["document"] == {"n": 3}
+
+### TRANSLATIONS ###
+
+@pytest.mark.parametrize("dedupe", [False, True])
+def test_getTranslations(manager, dedupe):
+    store = createStore(manager, dedupe=dedupe)
+    for language, titles in [("en", ["one", "two"]), ("nl", ["een"]), ("de", ["eins"])]:
+        for title in titles:
+            store.save(createDocument("page", {"title": title}, language))
+    translations = store.getTranslations("page", ["en", "nl", "fr"])
+    assert sorted(translations) == ["en", "nl"]
+    assert translations["en"]["document"] == {"title": "two"}
+    assert translations["nl"]["document"] == {"title": "een"}
+    translations = store.getTranslations("page", ["en"], fields=["metadata.version"])
+    assert translations["en"]["metadata"]["version"] == 1
+
+### DOCUMENT CACHE ###
+
+def test_putIfKeepsTheNewerValue():
+    cache = LRUCache(10)
+    newer = lambda version: lambda cached: cached is None or cached < version
+    assert cache.putIf("key", 2, newer(2))
+    assert not cache.putIf("key", 1, newer(1))
+    assert cache.get("key") == 2
+
+def test_cachedDocumentIsACopy(manager):
+    store = createStore(manager, documentCache=LRUCache(100))
+    body = {"title": "saved"}
+    store.save(createDocument("page", body))
+    body["title"] = "changed after the save"
+    result = store.getLastByURI("page", "en")
+    assert result["document"] == {"title": "saved"}
+    result["document"]["title"] = "changed by a reader"
+    assert store.getLastByURI("page", "en")["document"] == {"title": "saved"}
+
+def test_cacheSharedByStoresReturnsNewest(manager):
+    cache = LRUCache(100)
+    first = createStore(manager, documentCache=cache)
+    second = createStore(manager, documentCache=cache)
+    first.save(createDocument("page", {"n": 0}))
+    assert first.getLastByURI("page", "en")["document"] == {"n": 0}
+    second.save(createDocument("page", {"n": 1}))
+    assert first.getLastByURI("page", "en")["document"] == {"n": 1}
+
+def test_validateCacheSeesSavesOfOtherProcesses(manager):
+    cached = createStore(manager, documentCache=LRUCache(100), validateCache=True)
+    other = createStore(manager)
+    cached.save(createDocument("page", {"n": 0}))
+    assert cached.getLastByURI("page", "en")["document"] == {"n": 0}
+    other.save(createDocument("page", {"n": 1}))
+    assert cached.getLastByURI("page", "en")["document"] == {"n": 1}
+
+def test_validateCacheAfterFailedSave():
+    server = benchmark.FakeServer()
+    store = createStore(benchmark.FakeConnectionManager(server, benchmark.FakeServer()), documentCache=LRUCache(100), validateCache=True)
+    store.save(createDocument("page", {"n": 0}))
+    collection = store.collection
+    #The save fails after its version is reserved
+    def update(*args, **kwargs):
+        raise RuntimeError("connection lost")
+    collection.update = update
+    with pytest.raises(RuntimeError):
+        store.save(createDocument("page", {"n": 1}))
+    del collection.update
+    assert store.getLastByURI("page", "en")["document"] == {"n": 0}
+    requests = server.requests
+    assert store.getLastByURI("page", "en")["document"] == {"n": 0}
+    #Only the validation, the document comes from the cache
+    assert server.requests - requests == 1
+
+### COMPACTION ###
+
+def test_compactResumesFromAfter(manager):
+    store = createStore(manager, keepVersions=2)
+    for uri in ["a", "b", "c"]:
+        for n in range(4):
+            store.save(createDocument(uri, {"n": n}))
+    batches = store.compact(batchSize=2)
+    first = next(batches)
+    batches.close()
+    archived = first["archived"] + sum(result["archived"] for result in store.compact(batchSize=2, after=first["after"]))
+    assert archived == 6
+    for uri in ["a", "b", "c"]:
+        assert versions(store, uri) == [(2, False), (3, True)]
+        assert [record["metadata"]["version"] for record in store.getAllByURI(uri, "en", archived=True)] == [0, 1, 2, 3]
+    #A repeated compaction finds nothing left to archive
+    assert sum(result["archived"] for result in store.compact(batchSize=2)) == 0
+
+def test_compactKeepsActiveVersions(manager):
+    store = createStore(manager, keepVersions=1, maxAge=0)
+    for n in range(3):
+        store.save(createDocument("page", {"n": n}))
+    list(store.compact())
+    assert versions(store, "page") == [(2, True)]
+    assert store.getLastByURI("page", "en")["document"] == {"n": 2}
+
+### INSTRUMENTATION ###
+
+def test_instrumentationCountsRoundTripsPerCall(manager):
+    store = createStore(manager)
+    store.save(createDocument("page", {"n": 0}))
+    instrumentation = Instrumentation()
+    store.enableInstrumentation(instrumentation)
+    store.save(createDocument("page", {"n": 1}))
+    store.getLastByURI("page", "en")
+    assert instrumentation.calls == {"save": 1, "getLastByURI": 1}
+    assert instrumentation.roundTripsPerCall("save") == {"mongo": 3.0}
+    store.disableInstrumentation()
+    store.save(createDocument("page", {"n": 2}))
+    assert instrumentation.calls["save"] == 1
+
+### SHARED CONNECTIONS ###
+
+def test_storesOfAManagerShareConnectionsAndCaches(manager):
+    first = createStore(manager)
+    second = createStore(manager)
+    assert first.collection is second.collection
+    createReader(first)
+    first.getRoles("tester", "r")
+    before = second.cacheStats["roles"]["hits"]
+    assert second.getRoles("tester", "r") == ["public"]
+    assert second.cacheStats["roles"]["hits"] == before + 1
+    assert createStore(benchmark.FakeConnectionManager(benchmark.FakeServer(), benchmark.FakeServer())).cacheStats["roles"]["hits"] == 0
+
+### CHANGE FEED ###
+
+def changes(store, checkpoint, batchSize=1000, **options):
+    """
+    @return ([(change, uri, version)], checkpoint after the last change)
+    """
+    found = list()
+    for change, document, checkpoint in store.getChanges(checkpoint, batchSize, **options):
+        found.append((change, document["metadata"]["uri"], document["metadata"]["version"]))
+    return found, checkpoint
+
+def test_changesResumeFromStoredCheckpoint(manager):
+    store = createStore(manager)
+    for uri in ["a", "b", "c"]:
+        store.save(createDocument(uri, {"uri": uri}))
+    found, checkpoint = changes(store, None, batchSize=1)
+    assert found == [("saved", "a", 0), ("saved", "b", 0), ("saved", "c", 0)]
+    store.save(createDocument("a", {"n": 1}))
+    store.saveCheckpoint("consumer", checkpoint)
+    found, checkpoint = changes(store, store.getCheckpoint("consumer"), batchSize=1)
+    assert found == [("saved", "a", 1), ("deactivated", "a", 0)]
+    assert changes(store, checkpoint)[0] == []
+
+def insertLate(store, id, uri):
+    metadata = createDocument(uri, {}).metadata
+    metadata["version"] = 0
+    store.collection.insert(dict(_id=id, metadata=metadata, document={}))
+
+def test_changesIncludeLateWrites(manager):
+    store = createStore(manager)
+    #A writer took its id before the other saves but its insert becomes visible after the checkpoint passed them
+    late = ObjectId()
+    for uri in ["a", "b"]:
+        store.save(createDocument(uri, {"uri": uri}))
+    found, checkpoint = changes(store, None)
+    assert [uri for change, uri, version in found] == ["a", "b"]
+    insertLate(store, late, "late")
+    found, checkpoint = changes(store, checkpoint)
+    assert found == [("saved", "late", 0)]
+    assert changes(store, checkpoint)[0] == []
+
+def test_changesCheckpointKeepsAtMostMaxSeen(manager):
+    store = createStore(manager)
+    late = ObjectId()
+    list(store.saveMany([createDocument("page%d" % i, {}) for i in range(10)]))
+    found, checkpoint = changes(store, None, maxSeen=4)
+    assert len(found) == 10
+    assert len(checkpoint["savedSeen"]) == 4
+    #Only the changes after the oldest kept one are read again
+    insertLate(store, late, "late")
+    assert changes(store, checkpoint, maxSeen=4)[0] == []
+    assert changes(store, None, maxSeen=4)[0][0] == ("saved", "late", 0)
+
+def test_seenChangesBookkeepingIsLinear():
+    checkpoint = dict(saved=None, savedSeen=list(), savedFrom=None)
+    seen = documentStore.SeenChanges("saved", checkpoint, timedelta(seconds=60), 1000)
+    start = time.time()
+    for i in range(20000):
+        seen.add(ObjectId())
+        seen.store(checkpoint)
+    assert len(checkpoint["savedSeen"]) == 1000
+    assert time.time() - start < 5
+
+### DEDUPE ###
+
+def test_getBySearchLoadsDedupedBodies(manager):
+    store = createStore(manager, dedupe=True)
+    createReader(store)
+    list(store.saveMany([createDocument("page%d" % i, {"shared": True}) for i in range(5)]))
+    store.save(createDocument("other", {"shared": False}))
+    results = list(store.getBySearch("tester", {"metadata.uri": {"$in": ["page0", "page4", "other"]}}, "en", batchSize=2))
+    assert sorted((record["metadata"]["uri"], record["document"]["shared"]) for record in results) == [("other", False), ("page0", True), ("page4", True)]
+
+### LARGE BODIES ###
+
+@pytest.mark.parametrize("dedupe", [False, True])
+@pytest.mark.parametrize("fullText", [False, True])
+def test_largeBodies(manager, dedupe, fullText):
+    store = createStore(manager, dedupe=dedupe, fullText=fullText, largeThreshold=64)
+    large = {"text": "large body " * 20}
+    small = {"text": "small"}
+    #A chunk of only large bodies has no blobs to write
+    list(store.saveMany([createDocument("large", large), createDocument("large", large)]))
+    list(store.saveMany([createDocument("mixed", small), createDocument("mixed", large)]))
+    store.save(createDocument("single", large))
+    for uri in ["large", "mixed", "single"]:
+        assert store.getLastByURI(uri, "en")["document"] == large
+        assert store.openBody(uri, "en").read().decode("utf-8").startswith('{"text": "large body')
+    assert store.getAllByURI("mixed", "en")[0]["document"] == small
+    for record in store.collection.documents:
+        assert "document" not in record or record["document"] == small
+        if fullText and record["metadata"]["active"]:
+            assert len(record["text"]) <= 64
+        else:
+            assert "text" not in record
+    #A store without largeThreshold reads the large bodies too
+    assert createStore(manager, dedupe=dedupe).getLastByURI("single", "en")["document"] == large
+
+@pytest.mark.parametrize("dedupe", [False, True])
+def test_getBySearchLoadsLargeBodies(manager, dedupe):
+    store = createStore(manager, dedupe=dedupe, largeThreshold=64)
+    createReader(store)
+    large = {"text": "large body " * 20}
+    list(store.saveMany([createDocument("large%d" % i, large) for i in range(3)] + [createDocument("small", {"text": "small"})]))
+    results = list(store.getBySearch("tester", language="en", batchSize=2))
+    assert sorted((record["metadata"]["uri"], record["document"]) for record in results) == [
+        ("large0", large), ("large1", large), ("large2", large), ("small", {"text": "small"})]
@@ -0,0 +1,100 @@
+"""
+Tests of the migration from the Neo4j store to the MongoDB store against the in-process fakes of benchmark.py
+"""
+import contextlib
+import io
+import pytest
+
+pytest.importorskip("py2neo")
+pytest.importorskip("pymongo")
+pytest.importorskip("bson")
+
+import benchmark
+import documentStore
+import GraphDB_CMS
+import migrate
+
+@pytest.fixture
+def manager():
+    manager = benchmark.FakeConnectionManager(benchmark.FakeServer(), benchmark.FakeServer())
+    fake = benchmark.FakeNeo4j(manager.graph("fake"))
+    fake.install()
+    GraphDB_CMS.VALUE_NODES.clear()
+    yield manager
+    fake.uninstall()
+
+def createStores(manager):
+    """
+    @return (graphStore, mongoStore) sharing the fakes of manager
+    """
+    return GraphDB_CMS.DocumentStore("fake", connectionManager=manager), documentStore.DocumentStore("fake", 0, connectionManager=manager)
+
+def save(store, name, contents, language="EN", user="tester", attributes=()):
+    #New documents print a message
+    with contextlib.redirect_stdout(io.StringIO()):
+        document = store.createDocument(name, language)
+    for key, value, translatable in attributes:
+        document.addAttribute(key, value, translatable)
+    for content in contents:
+        document.addContent(content)
+        document.saveFile(user)
+
+def versions(store, uri, language="en"):
+    """
+    @return the contents of the versions of uri, oldest first
+    """
+    return [record["document"]["content"] for record in store.getAllByURI(uri, language)]
+
+def test_migrate(manager):
+    graphStore, mongoStore = createStores(manager)
+    save(graphStore, "page", ["one", "two"], attributes=[("color", "red", None), ("title", "Page", "EN")])
+    save(graphStore, "page", ["een"], language="NL")
+    save(graphStore, "other", ["other"], user="editor")
+    result = migrate.Migration(graphStore, mongoStore, pageSize=1, workers=2).run()
+    assert (result["documents"], result["versions"]) == (2, 4)
+    assert versions(mongoStore, "page") == ["one", "two"]
+    assert versions(mongoStore, "page", "nl") == ["een"]
+    assert mongoStore.getLastByURI("page", "en")["document"]["attributes"] == {"color": ["red"], "title": ["Page"]}
+    assert mongoStore.getLastByURI("page", "nl")["document"]["attributes"] == {"color": ["red"]}
+    assert mongoStore.getLastByURI("other", "en")["metadata"]["groups"] == [migrate.userGroup("editor")]
+    assert [group["groupname"] for group in mongoStore.getUser("tester").groups] == [migrate.userGroup("tester")]
+
+def test_migrateResumesFromCheckpoint(manager, tmp_path):
+    graphStore, mongoStore = createStores(manager)
+    for name in ["a", "b", "c"]:
+        save(graphStore, name, [name + "1", name + "2"])
+    checkpoint = str(tmp_path / "migrate.json")
+    migration = migrate.Migration(graphStore, mongoStore, pageSize=1, workers=1, checkpoint=checkpoint)
+    migratePage = migration.migratePage
+    def interrupted(names):
+        if names == ["b"]:
+            raise RuntimeError("interrupted")
+        return migratePage(names)
+    migration.migratePage = interrupted
+    with pytest.raises(RuntimeError):
+        migration.run()
+    result = migrate.Migration(graphStore, mongoStore, pageSize=1, workers=1, checkpoint=checkpoint).run()
+    #Page c was written before the interruption, only its missing versions are written again
+    assert (result["documents"], result["versions"]) == (2, 2)
+    for name in ["a", "b", "c"]:
+        assert versions(mongoStore, name) == [name + "1", name + "2"]
+
+def test_migrateSkipsMigratedVersions(manager):
+    graphStore, mongoStore = createStores(manager)
+    save(graphStore, "page", ["one", "two"])
+    migrate.Migration(graphStore, mongoStore).run()
+    save(graphStore, "page", ["three"])
+    result = migrate.Migration(graphStore, mongoStore).run()
+    assert result["versions"] == 1
+    assert versions(mongoStore, "page") == ["one", "two", "three"]
+
+def test_migrateDoesNotChangeCachedUsers(manager):
+    graphStore, mongoStore = createStores(manager)
+    user = documentStore.User("tester")
+    user.addGroup("public", ["r"])
+    mongoStore.createUser(user)
+    cached = mongoStore.getUser("tester")
+    save(graphStore, "page", ["one"])
+    migrate.Migration(graphStore, mongoStore).run()
+    assert [group["groupname"] for group in cached.groups] == ["public"]
+    assert [group["groupname"] for group in mongoStore.getUser("tester").groups] == ["public", migrate.userGroup("tester")]